@@ -1,33 +1,256 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from translateFOF import treeToSexp, translateFOF_formula, removeDuplicateQuantifiedVars
 from FOL_resolution import printSExpNice, propStructToSExp, findContradiction, parseExpression, applySubstitution
 # from rewriteRules import *
 import os
 import sys
 import re
+import socket
+import subprocess
+import threading
+import multiprocessing
+import queue
+import time
+import atexit
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict
+from tptp_cache import TPTPCache
 
 #requires installation of APE: https://github.com/Attempto/APE
 #and swi-prolog: https://www.swi-prolog.org/
 
 APE_dir = "pattern_folder/APE" #directory containing ape.exe and clex_lexicon.pl.
 
+APE_webservice_url = 'http://attempto.ifi.uzh.ch/ws/ape/apews.perl' #can be pointed at a self-hosted APE webservice (ape.exe -httpserver)
+
+"""Client for the APE webservice. Keeps a pool of keep-alive connections to the server, URL-encodes the text properly, and
+retries failed requests (connection errors and 429/5xx responses) with exponential backoff.
+FOR MORE INFORMATION ON THE WEBSERVICE REFER TO http://attempto.ifi.uzh.ch/site/docs/ape_webservice.html
+"""
+class APEWebClient:
+	def __init__(self, url=None, timeout=30, retries=3, backoff=0.5, maxInFlight=8):
+		self.url = url if url != None else APE_webservice_url
+		self.timeout = timeout
+		self.maxInFlight = maxInFlight
+		self.session = requests.Session()
+		retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=[429, 500, 502, 503, 504])
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=maxInFlight, max_retries=retry)
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+
+	"""Returns the TPTP translation of sentence, or None if the webservice reported an error."""
+	def translate(self, sentence):
+		r = self.session.get(self.url, params={'text':sentence, 'solo':'tptp'}, timeout=self.timeout)
+		if r.text.find('error') == -1:
+			return r.text#.replace('\n', '')
+		else:
+			return None
+
+	"""Translates a list of sentences with at most maxInFlight requests running at once (never more than the client's
+	maxInFlight, which is the number of connections it keeps). Returns a list of the same length; sentences whose request
+	failed even after retrying are returned as None."""
+	def translateMany(self, sentences, maxInFlight=None):
+		def translateOne(sentence):
+			try:
+				return self.translate(sentence)
+			except requests.RequestException as e:
+				print("APE webservice request failed for:", sentence, "\n\t", e)
+				return None
+		if maxInFlight == None or maxInFlight > self.maxInFlight:
+			maxInFlight = self.maxInFlight
+		with ThreadPoolExecutor(max_workers=maxInFlight) as executor:
+			return list(executor.map(translateOne, sentences))
+
+	def close(self):
+		self.session.close()
+
+apeWebClient = None #created on first use by sentenceToTPTP_web()
+apeWebClientLock = threading.Lock()
+
+def _getWebClient():
+	global apeWebClient
+	with apeWebClientLock:
+		if apeWebClient == None:
+			apeWebClient = APEWebClient()
+		return apeWebClient
+
 """Call APE webservice to translate a sentence into TPTP format."""
 def sentenceToTPTP_web(sentence):
-	# THE URL FOR THE APE WEBSERVICE
-	main_url = 'http://attempto.ifi.uzh.ch/ws/ape/apews.perl?text='
-	# FOR MORE INFORMATION ON THE WEBSERVICE REFER TO http://attempto.ifi.uzh.ch/site/docs/ape_webservice.html
-	addition_url = '&solo=tptp'
-	result = []
-	sentence = sentence.replace(' ', '+') + addition_url
-	# print("full request:", main_url + sentence)
-	r = requests.get(main_url+sentence)
-	if r.text.find('error') == -1:
-		return r.text#.replace('\n', '')
-	else:
+	return _getWebClient().translate(sentence)
+
+"""Call APE webservice to translate a list of sentences into TPTP format, several at a time (see APEWebClient.translateMany)."""
+def sentenceToTPTP_web_many(sentences, maxInFlight=None):
+	return _getWebClient().translateMany(sentences, maxInFlight)
+
+"""A single resident APE process, started with ape.exe's socket interface (-server). The lexicon is loaded once when the 
+worker starts, so each request only pays for parsing. If the process crashes or a request takes longer than timeout seconds,
+the process is killed and restarted.
+"""
+class APEWorker:
+	def __init__(self, timeout=30, startupTimeout=60):
+		self.timeout = timeout
+		self.startupTimeout = startupTimeout
+		self.process = None
+		self.port = None
+
+	def start(self):
+		self.port = _findFreePort()
+		self.process = subprocess.Popen(["./ape.exe", "-server", "-port", str(self.port)], cwd=APE_dir,
+			stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		#wait until the server accepts connections. The first request also loads clex_lexicon.pl, which then stays loaded.
+		deadline = time.time() + self.startupTimeout
+		while True:
+			if self.process.poll() != None:
+				raise Exception("APE worker exited during startup (port %d)" % self.port)
+			try:
+				self._request("John waits.", ulexfile="clex_lexicon.pl")
+				return
+			except OSError:
+				if time.time() > deadline:
+					self.stop()
+					raise Exception("APE worker did not start within %d seconds (port %d)" % (self.startupTimeout, self.port))
+				time.sleep(0.1)
+
+	def stop(self):
+		if self.process != None and self.process.poll() == None:
+			self.process.kill()
+			self.process.wait()
+		self.process = None
+
+	def restart(self):
+		self.stop()
+		self.start()
+
+	#sends one get(...) request to the socket server and returns everything it writes before APESERVERSTREAMEND. Raises
+	#ConnectionError if the server closes the connection before that (e.g. because ape.exe died), so a partial reply is never used.
+	def _request(self, sentence, ulexfile=None):
+		params = ["text=" + _prologAtom(sentence), "solo=tptp"]
+		if ulexfile != None:
+			params.append("ulexfile=" + _prologAtom(ulexfile))
+		conn = socket.create_connection(("127.0.0.1", self.port), timeout=self.timeout)
+		try:
+			conn.sendall(("get([" + ", ".join(params) + "]).\n").encode("utf-8"))
+			buf = b""
+			while b"APESERVERSTREAMEND" not in buf:
+				data = conn.recv(65536)
+				if not data:
+					raise ConnectionError("APE worker closed the connection before the end of its reply (port %d)" % self.port)
+				buf += data
+		finally:
+			conn.close()
+		return buf.decode("utf-8").split("APESERVERSTREAMEND")[0]
+
+	"""Returns the raw APE output for sentence, or None if the worker timed out or crashed twice on it."""
+	def translate(self, sentence):
+		for attempt in range(2):
+			if self.process == None or self.process.poll() != None:
+				self.restart()
+			try:
+				return self._request(sentence)
+			except socket.timeout:
+				print("APE worker timed out after", self.timeout, "seconds on:", sentence)
+				self.restart()
+				return None
+			except OSError as e:
+				print("APE worker crashed (" + str(e) + "), restarting...")
+				self.restart()
 		return None
 
+"""A fixed number of APEWorkers. translate() blocks until one of them is idle, so it can be called from several threads."""
+class APEWorkerPool:
+	def __init__(self, numWorkers=1, timeout=30):
+		self.workers = []
+		self.idle = queue.Queue()
+		for _ in range(numWorkers):
+			w = APEWorker(timeout)
+			w.start()
+			self.workers.append(w)
+			self.idle.put(w)
+
+	def translate(self, sentence):
+		w = self.idle.get()
+		try:
+			return w.translate(sentence)
+		finally:
+			self.idle.put(w)
+
+	def close(self):
+		for w in self.workers:
+			w.stop()
+		self.workers = []
+
+apeWorkerPool = None #set by startAPEWorkers()
+apeWorkerLock = threading.Lock()
+
+"""Starts numWorkers resident APE processes. After this is called, sentenceToTPTP() uses them instead of running ape.exe once per sentence.
+timeout = number of seconds a single sentence may take before its worker is restarted and the sentence is treated as unparseable.
+"""
+def startAPEWorkers(numWorkers=1, timeout=30):
+	global apeWorkerPool
+	with apeWorkerLock:
+		if apeWorkerPool != None:
+			apeWorkerPool.close()
+		apeWorkerPool = APEWorkerPool(numWorkers, timeout)
+	return apeWorkerPool
+
+def stopAPEWorkers():
+	global apeWorkerPool
+	with apeWorkerLock:
+		if apeWorkerPool != None:
+			apeWorkerPool.close()
+			apeWorkerPool = None
+
+atexit.register(stopAPEWorkers)
+
+def _findFreePort():
+	with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+		s.bind(("127.0.0.1", 0))
+		return s.getsockname()[1]
+
+#quotes a string as a Prolog atom, e.g. John's => 'John\'s'
+def _prologAtom(s):
+	return "'" + s.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+"""Checks the raw output of APE for errors and fixes known APE bugs. Returns None if APE failed to parse."""
+def _cleanAPEOutput(r):
+	r = r.strip()
+	if 'importance="error"' in r or r=="":
+		return None
+	else:
+		#the APE code has a bug where whenever "Table" appears, it converts it to (table X) instead of table(X).
+		return re.sub(r'\(table ([a-zA-Z0-9]+)\)', r'\(table\(\1\)\)', r)#.replace('\n', '')
+
+tptpCache = None #set by enableTPTPCache()
+
+"""Returns a string identifying the version of clex_lexicon.pl in APE_dir (a hash of its contents), or '' if it can't be read."""
+def lexiconVersion():
+	try:
+		with open(os.path.join(APE_dir, "clex_lexicon.pl"), 'rb') as F:
+			return hashlib.sha1(F.read()).hexdigest()
+	except OSError:
+		return ''
+
+"""Makes sentenceToTPTP() look up and store its results in the on-disk cache at path (see tptp_cache.TPTPCache).
+Returns the cache, so its hit/miss counters can be read with cache.stats().
+"""
+def enableTPTPCache(path, maxEntries=2000000):
+	global tptpCache
+	tptpCache = TPTPCache(path, lexiconVersion(), maxEntries)
+	return tptpCache
+
 #Uses local version of APE to parse sentence into TPTP.
+#If startAPEWorkers() has been called, the sentence is sent to one of the resident APE workers instead of starting a new ape.exe.
+#If enableTPTPCache() has been called, sentences that were translated before are not sent to APE at all.
 def sentenceToTPTP(sentence):
+	if tptpCache != None:
+		[found, tptp] = tptpCache.get(sentence)
+		if found:
+			return tptp
+	if apeWorkerPool != None:
+		return _translateWithPool(apeWorkerPool, sentence)
 	# pwd = os.popen("pwd").read()
 	# r = os.popen("cd ~ && ls").read()
 	# print("R:", r)
@@ -36,11 +259,70 @@ def sentenceToTPTP(sentence):
 	# r = os.popen("cd /Users/licato/Downloads/APE-master && ./ape.exe -text \"" + sentence + "\" -solo tptp -ulexfile \"clex_lexicon.pl\"").read().strip() 
 	# print("going back to ", pwd)
 	# os.popen("cd \"" + pwd + "\"")
-	if 'importance="error"' in r or r=="":
+	if r=='': #ape.exe didn't run (e.g. APE_dir is wrong) or crashed, so don't cache this as a parse failure
+		_countTransientFailure()
 		return None
-	else:
-		#the APE code has a bug where whenever "Table" appears, it converts it to (table X) instead of table(X).
-		return re.sub(r'\(table ([a-zA-Z0-9]+)\)', r'\(table\(\1\)\)', r)#.replace('\n', '')
+	return _storeTPTP(sentence, _cleanAPEOutput(r))
+
+_numTransientFailures = 0 #number of sentences an APE worker timed out or crashed on, or ape.exe gave no output for
+_transientFailureLock = threading.Lock() #sentenceToTPTP_many() translates in several threads
+
+#returns the number of sentences an APE worker timed out or crashed on (or ape.exe gave no output for) so far. What was
+#computed from those sentences' translations (None) shouldn't be cached, since they may well parse on the next try.
+def transientFailureCount():
+	return _numTransientFailures
+
+def _countTransientFailure():
+	global _numTransientFailures
+	with _transientFailureLock:
+		_numTransientFailures += 1
+
+def _translateWithPool(pool, sentence):
+	r = pool.translate(sentence)
+	if r==None: #the worker timed out or crashed, so don't cache this as a parse failure
+		_countTransientFailure()
+		return None
+	return _storeTPTP(sentence, _cleanAPEOutput(r))
+
+def _storeTPTP(sentence, tptp):
+	if tptpCache != None:
+		tptpCache.put(sentence, tptp)
+	return tptp
+
+"""Translates a list of ACE sentences into TPTP. Returns a list of the same length as sentences, where each element is what
+sentenceToTPTP() would have returned for it (None if that sentence failed to parse).
+The sentences are not joined into a single APE text: APE would then resolve anaphora across sentence boundaries, and one
+sentence with an error would make the whole text fail. Instead, every sentence goes to a resident APE worker, so process
+startup and lexicon loading are paid once per worker rather than once per sentence, and the workers run in parallel.
+Duplicates are only parsed once. If startAPEWorkers() has not been called, numWorkers temporary workers are started for
+this call and stopped afterwards. If numWorkers is 0, ape.exe is started once per sentence instead, like sentenceToTPTP() does
+without workers.
+"""
+def sentenceToTPTP_many(sentences, numWorkers=1):
+	results = dict()
+	toParse = []
+	for s in dict.fromkeys(sentences):
+		if tptpCache != None:
+			[found, tptp] = tptpCache.get(s)
+			if found:
+				results[s] = tptp
+				continue
+		toParse.append(s)
+	if len(toParse) > 0 and apeWorkerPool == None and numWorkers <= 0:
+		for s in toParse:
+			results[s] = sentenceToTPTP(s)
+	elif len(toParse) > 0:
+		pool = apeWorkerPool
+		if pool == None:
+			pool = APEWorkerPool(min(numWorkers, len(toParse)))
+		try:
+			with ThreadPoolExecutor(max_workers=len(pool.workers)) as executor:
+				for (s, tptp) in zip(toParse, executor.map(lambda s: _translateWithPool(pool, s), toParse)):
+					results[s] = tptp
+		finally:
+			if pool != apeWorkerPool:
+				pool.close()
+	return [results[s] for s in sentences]
 
 """Takes a sequence of tptp formulae (in string form), removes any formulae with single unnecessary equalities (see below), and returns a single S-expression string (all ANDed together).
 Unnecessary equalities are formulae that are existentially quantified, where there is a single clause in the scope of the quantifier that has an equality with the
@@ -144,12 +426,81 @@ def tptpsToSexp(tptp, returnList=False):
 			return "(AND " + ' '.join([propStructToSExp(t) for t in newTs]) + ")"
 
 
+proverMode = 'sequential' #'sequential': the contradiction check is skipped when entailment is proven. 'parallel': both checks run at once in separate processes (except in daemonic processes, e.g. the workers of run_S3.py parallel, which can't start any).
+proverCacheSize = 2000 #number of findContradiction() results to remember (see _refute)
+_refutationCache = OrderedDict() #(maxNumClauses, formulas) -> result of _refute()
+_proverExecutor = None
+_abandonedRefutations = dict() #(maxNumClauses, formulas) -> Future of a check _refuteParallel() no longer needed, but couldn't cancel
+
+#runs the resolution prover on a tuple of s-expression strings, returns True if a contradiction was found.
+def _refute(formulas, maxNumClauses):
+	[result,trace,clauses] = findContradiction(list(formulas), maxNumClauses, verbose=False, returnTrace=True)
+	return bool(result)
+
+#Results of _refute() for recently seen formula sets, keyed by (maxNumClauses, formulas) since the prover may give up sooner
+#with fewer clauses. In run_S3.py the later stages often send exactly the same query again (e.g. when S1/S2/S3 didn't add or
+#change anything), so these are answered without running the prover.
+def _cachedRefutation(key):
+	if key in _refutationCache:
+		_refutationCache.move_to_end(key)
+		return _refutationCache[key]
+	return None
+
+def _storeRefutation(key, result):
+	_refutationCache[key] = result
+	if len(_refutationCache) > proverCacheSize:
+		_refutationCache.popitem(last=False)
+
+def _refuteCached(formulas, maxNumClauses):
+	key = (maxNumClauses, formulas)
+	result = _cachedRefutation(key)
+	if result == None:
+		result = _refute(formulas, maxNumClauses)
+		_storeRefutation(key, result)
+	return result
+
+#Runs the entailment and contradiction checks at the same time in a pool of two processes. Returns [entailment, contradiction].
+#If entailment is proven, we don't wait for the contradiction check (it is answered as False, like in sequential mode).
+#Note that a check that has already started can't be cancelled: it keeps running, and keeps one of the two processes busy,
+#until the prover is done with it. Its result is then cached by a later call (which also reuses it if it asks the same query).
+def _refuteParallel(entailmentQuery, contradictionQuery, maxNumClauses):
+	global _proverExecutor
+	if _proverExecutor == None:
+		_proverExecutor = ProcessPoolExecutor(max_workers=2)
+	for [key, future] in list(_abandonedRefutations.items()):
+		if future.done():
+			del _abandonedRefutations[key]
+			if future.exception() == None:
+				_storeRefutation(key, future.result())
+	pending = dict()
+	for q in [entailmentQuery, contradictionQuery]:
+		key = (maxNumClauses, q)
+		if _cachedRefutation(key) == None:
+			if key in _abandonedRefutations:
+				pending[q] = _abandonedRefutations.pop(key)
+			else:
+				pending[q] = _proverExecutor.submit(_refute, q, maxNumClauses)
+	def getResult(q):
+		key = (maxNumClauses, q)
+		if q in pending:
+			_storeRefutation(key, pending[q].result())
+		return _cachedRefutation(key)
+	if getResult(entailmentQuery):
+		if contradictionQuery in pending and not pending[contradictionQuery].cancel():
+			_abandonedRefutations[(maxNumClauses, contradictionQuery)] = pending[contradictionQuery]
+		return [True, False]
+	return [False, getResult(contradictionQuery)]
+
 """Determines if the natural language sentence s2 follows from s1.
 Returns: 0 (neutral), 1 (entailment), 2 (contradiction), or
 -2 - error or failure to parse on both hypothesis and at least one premise sentence
 -1 - error or failure to parse on either hypothesis or at least one premise sentence
 additionalFormulas = additional formulas to add into the resolution prover step. Must be s-expression strings.
 if passingFormulas==True, then s1 and s2 are expected to be s-expression strings rather than NL sentences.
+Entailment takes precedence over contradiction, so the contradiction check is only run if entailment could not be proven
+(or, if proverMode=='parallel', both are started at once and the contradiction result is ignored when entailment is proven).
+A daemonic process (such as a multiprocessing.Pool worker) isn't allowed to start the processes for that, so it always
+runs them one after the other.
 """
 def sentenceEntailment(s1, s2, passingFormulas=False, maxNumClauses=1500, additionalFormulas=[]):
 	if not passingFormulas:
@@ -166,12 +517,15 @@ def sentenceEntailment(s1, s2, passingFormulas=False, maxNumClauses=1500, additi
 		parsedPremise = propStructToSExp(s1)
 		parsedHypothesis = propStructToSExp(s2)
 	# print("S-exps:\n\t", parsedPremise, '\n\t', parsedHypothesis)
-	#test for entailment
-	[result,trace,clauses] = findContradiction(additionalFormulas + [parsedPremise, "(NOT " + parsedHypothesis + ")"], maxNumClauses, verbose=False, returnTrace=True)
-	entailment = result
-	#test for contradiction
-	[result,trace,clauses] = findContradiction(additionalFormulas + [parsedPremise, parsedHypothesis], maxNumClauses, verbose=False, returnTrace=True)
-	contradiction = result
+	entailmentQuery = tuple(additionalFormulas + [parsedPremise, "(NOT " + parsedHypothesis + ")"])
+	contradictionQuery = tuple(additionalFormulas + [parsedPremise, parsedHypothesis])
+	if proverMode == 'parallel' and not multiprocessing.current_process().daemon:
+		[entailment, contradiction] = _refuteParallel(entailmentQuery, contradictionQuery, maxNumClauses)
+	else:
+		#test for entailment
+		entailment = _refuteCached(entailmentQuery, maxNumClauses)
+		#test for contradiction
+		contradiction = (not entailment) and _refuteCached(contradictionQuery, maxNumClauses)
 	if entailment:
 		return 1
 	elif contradiction:
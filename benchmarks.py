@@ -0,0 +1,188 @@
+"""
+Micro-benchmarks for hot spots of the pipeline. They use synthetic inputs or the SNLI parses in snliLocation, so neither
+the CoreNLP server nor APE has to be running. Usage:
+python benchmarks.py                runs all of them
+python benchmarks.py rewriteRules   runs only the named benchmark(s)
+"""
+import sys
+import time
+import timeit
+
+snliLocation = "snli/snli_1.0_dev.txt"
+
+#how coref_resolution.parseCrc used to work: rewrite the text format of the chain into a python literal and eval() it
+def parseCrc_eval(crc):
+	toReturn = []
+	thisMention = "{"
+	for l in crc.split('\n'):
+		if l.strip()=="mention {" or l.strip()=='':
+			pass
+		elif l.strip()=='}':
+			thisMention += '}'
+			toReturn.append(eval(thisMention))
+			thisMention = "{"
+		elif ':' in l:
+			l = l.strip()
+			thisMention += "'" + l[:l.index(':')] + "'" + l[l.index(':'):] + ', '
+	return toReturn
+
+#returns numChains CorefChain messages with mentionsPerChain mentions each, filled in like the ones CoreNLP returns
+def syntheticCorefChains(numChains, mentionsPerChain):
+	from stanfordnlp.protobuf import CorefChain
+	chains = []
+	for c in range(numChains):
+		chain = CorefChain()
+		chain.chainID = c
+		chain.representative = 0
+		for i in range(mentionsPerChain):
+			m = chain.mention.add()
+			m.mentionID = i
+			m.mentionType = ['PROPER', 'PRONOMINAL', 'NOMINAL'][i%3]
+			m.number = 'SINGULAR'
+			m.gender = 'MALE'
+			m.animacy = 'ANIMATE'
+			m.beginIndex = 2*i
+			m.endIndex = 2*i + 1
+			m.headIndex = 2*i
+			m.sentenceIndex = 0
+			m.position = i
+		chains.append(chain)
+	return chains
+
+def benchmarkParseCrc(numChains=2000, mentionsPerChain=3, repeat=5):
+	from coref_resolution import parseCrc
+	chains = syntheticCorefChains(numChains, mentionsPerChain)
+	old = parseCrc_eval(str(chains[0]))[0]
+	new = parseCrc(chains[0])[0]
+	for key in ['mentionType', 'beginIndex', 'endIndex', 'sentenceIndex', 'number']:
+		assert old[key] == new[key], key
+	variants = [
+		['eval of str(chain) (old)', lambda: [parseCrc_eval(str(c)) for c in chains]],
+		['parseCrc(str(chain))', lambda: [parseCrc(str(c)) for c in chains]],
+		['parseCrc(chain)', lambda: [parseCrc(c) for c in chains]],
+	]
+	print("parseCrc:", numChains, "chains of", mentionsPerChain, "mentions")
+	for (name, f) in variants:
+		t = min(timeit.repeat(f, number=1, repeat=repeat))
+		print("\t%-28s %8.2f us/chain" % (name, 1e6*t/numChains))
+
+#the constituency trees of the premises and hypotheses in snliLocation, with R9 applied (the input of the recursive rules)
+def snliTrees(limit=None):
+	from rewriteRules import parseConstituency, applyRule, R9
+	from run_S3 import cleanConstituency
+	from snli_reader import iterSNLI
+	trees = []
+	for pair in iterSNLI(snliLocation, 0, limit):
+		for s in [pair.sentence1_parse, pair.sentence2_parse]:
+			try:
+				trees.append(applyRule(parseConstituency(cleanConstituency(s)), R9, False)[1])
+			except Exception:
+				pass
+	return trees
+
+def benchmarkRewriteRules(limit=None, repeat=3):
+	from rewriteRules import applyRule, applyRules, copyTree, R1, R4, R5, R6, R7, R8
+	rules = [R1, R4, R5, R6, R7, R8]
+	trees = snliTrees(limit)
+	def sequential(T):
+		counts = []
+		for rule in rules:
+			[n, T] = applyRule(T, rule)
+			counts.append(n)
+		return [counts, T]
+	def singlePass(T):
+		backup = copyTree(T) #as in run_S3.applyRulesBeforeR3
+		return applyRules(T, rules)
+	#both have to give the same trees and counts (R1 modifies its input, so each one gets its own copy)
+	numFailed = 0
+	for T in trees:
+		try:
+			expected = sequential(copyTree(T))
+		except Exception:
+			numFailed += 1
+			continue
+		assert singlePass(copyTree(T)) == expected, T
+	print("rewrite rules R1, R4-R8:", len(trees), "trees from", snliLocation, "(%d raise an exception and are skipped)" % numFailed)
+	for (name, f) in [['applyRule once per rule', sequential], ['applyRules (single pass)', singlePass]]:
+		times = []
+		for r in range(repeat):
+			inputs = [copyTree(T) for T in trees]
+			startTime = time.perf_counter()
+			for T in inputs:
+				try:
+					f(T)
+				except Exception:
+					pass
+			times.append(time.perf_counter() - startTime)
+		print("\t%-28s %8.2f us/tree" % (name, 1e6*min(times)/len(trees)))
+
+#what solveRewritten() reads from each rewritten tree: its ACE input (twice, when it is written to an output file), and its
+#nouns and verbs for S1 and S2. A premise tree is read by each of its problems (usually 3), which share one ConstituencyTree.
+def benchmarkTreeQueries(limit=None, repeat=3):
+	from rewriteRules import treeToACEInput, getWordsByPOS, getTagSequence, getWordSequence
+	from constituency_tree import ConstituencyTree
+	trees = snliTrees(limit)
+	for T in trees:
+		C = ConstituencyTree.fromList(T)
+		assert C.toList() == T
+		assert getWordSequence(C) == getWordSequence(T) and getTagSequence(C) == getTagSequence(T), T
+		assert treeToACEInput(C) == treeToACEInput(T), T
+		for tags in [['NN','NNS','NNP','NNPS'], ['VB', 'VBZ', 'VBP']]:
+			assert getWordsByPOS(C, tags) == getWordsByPOS(T, tags), T
+	def queries(T):
+		for i in range(2):
+			treeToACEInput(T)
+		getWordsByPOS(T, ['NN','NNS','NNP','NNPS'])
+		getWordsByPOS(T, ['VB', 'VBZ', 'VBP'])
+	variants = [
+		['nested lists', lambda: [queries(T) for T in trees]],
+		['ConstituencyTree.fromList', lambda: [queries(ConstituencyTree.fromList(T)) for T in trees]],
+		['nested lists, read 3 times', lambda: [queries(T) for T in trees for k in range(3)]],
+		['ConstituencyTree, read 3 times', lambda: [queries(C) for T in trees for C in [ConstituencyTree.fromList(T)] for k in range(3)]],
+	]
+	print("tree queries:", len(trees), "trees from", snliLocation)
+	for (name, f) in variants:
+		t = min(timeit.repeat(f, number=1, repeat=repeat))
+		print("\t%-32s %8.2f us/tree" % (name, 1e6*t/len(trees)))
+
+#checks that parsePennTree() gives the same trees as parseExpression() (whichever FOL_resolution is installed) on the SNLI
+#parses, then times both and the cache in front of them
+def benchmarkParseConstituency(limit=None, repeat=5):
+	import rewriteRules
+	from rewriteRules import parseConstituency, parseConstituencyWithParseExpression
+	from constituency_tree import parsePennTree
+	from run_S3 import cleanConstituency
+	from snli_reader import iterSNLI
+	strings = [cleanConstituency(s) for pair in iterSNLI(snliLocation, 0, limit) for s in [pair.sentence1_parse, pair.sentence2_parse]]
+	numFallbacks = 0
+	for s in strings:
+		T = parsePennTree(s)
+		if T == None:
+			numFallbacks += 1
+		else:
+			assert T == parseConstituencyWithParseExpression(s), s
+	rewriteRules.parseCacheSize = len(strings)
+	rewriteRules.pennTreeChecks = 0
+	for s in strings:
+		parseConstituency(s)
+	variants = [
+		['replace + parseExpression (old)', lambda: [parseConstituencyWithParseExpression(s) for s in strings]],
+		['parsePennTree', lambda: [parsePennTree(s) for s in strings]],
+		['parseConstituency (cached)', lambda: [parseConstituency(s) for s in strings]],
+	]
+	print("parseConstituency:", len(strings), "strings from", snliLocation, "(%d left to parseExpression)" % numFallbacks)
+	for (name, f) in variants:
+		t = min(timeit.repeat(f, number=1, repeat=repeat))
+		print("\t%-32s %8.2f us/string" % (name, 1e6*t/len(strings)))
+
+benchmarks = {
+	'parseCrc': benchmarkParseCrc,
+	'rewriteRules': benchmarkRewriteRules,
+	'treeQueries': benchmarkTreeQueries,
+	'parseConstituency': benchmarkParseConstituency,
+}
+
+if __name__=="__main__":
+	names = sys.argv[1:] if len(sys.argv)>1 else list(benchmarks.keys())
+	for name in names:
+		benchmarks[name]()
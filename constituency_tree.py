@@ -0,0 +1,228 @@
+"""
+A compact, read-only representation of the constituency trees that rewriteRules.parseConstituency() returns as nested lists,
+e.g. ['ROOT', ['S', ['NP', ['DT', 'A'], ['NN', 'dog']], ['VP', ['VBZ', 'runs']]]].
+
+The nodes of a ConstituencyTree are stored in preorder, in parallel arrays: labels (the interned label of a node, or -1 if
+the node is a word), words (the word, or None if the node is labelled) and ends (the index after the last node of the
+node's subtree, so the children of node i are i+1, ends[i+1], ...). The word and tag sequences of a tree are computed once
+and cached, as is anything else stored with cached().
+
+A ConstituencyTree can be read like the list it was made from: T[0] is the label, T[1:] are the children (words are
+returned as strings, subtrees as ConstituencyTrees that share the arrays) and len(T) is 1 + the number of children. So code
+that only reads trees (e.g. S1, S2, S3) works on either. To modify it, convert it back with toList().
+"""
+from array import array
+
+#the placeholder labels parseConstituency() gives punctuation, and the words rewriteRules.getWordSequence() turns them back into
+punctuationNames = {'PERIOD':'.', 'QUESTIONMARK':'?', 'EXCLAMATION':'!'}
+
+#the punctuation nodes rewriteRules.parseConstituency() replaces (with a node whose label and word are both the name) or drops
+_punctuationNodes = {('.', '.'):'PERIOD', ('?', '?'):'QUESTIONMARK', ('!', '!'):'EXCLAMATION', (',', ','):None, (',', ';'):None}
+_punctuationLabels = set(label for (label, word) in _punctuationNodes)
+
+"""Parses s, a Penn-style tree such as '(ROOT (S (NP (DT A) (NN dog)) (VP (VBZ runs))))', into the nested list format, in a
+single pass and without recursion. It gives the same tree as rewriteRules.parseConstituency() did with str.replace() and
+parseExpression(): (. .), (? ?) and (! !) become (PERIOD PERIOD) etc., and (, ,) and (, ;) are dropped.
+Returns None if s is not a single well-formed tree, or if one of its words contains a comma (which parseExpression() treats
+as a separator).
+"""
+def parsePennTree(s):
+	if s.count(',') != 2*s.count('(, ,)') + s.count('(, ;)'):
+		return None #a comma outside of the punctuation nodes
+	root = None
+	node = None #the innermost node whose closing bracket hasn't been seen yet
+	parents = [] #the other ones, outermost first
+	for token in s.replace('(', ' ( ').replace(')', ' ) ').split():
+		if token == '(':
+			child = []
+			if node != None:
+				node.append(child)
+				parents.append(node)
+			elif root != None:
+				return None
+			else:
+				root = child
+			node = child
+		elif token == ')':
+			if not node:
+				return None
+			if len(node)==2 and node[0] in _punctuationLabels and isinstance(node[1], str) and (node[0], node[1]) in _punctuationNodes:
+				if len(parents)==0:
+					return None
+				name = _punctuationNodes[(node[0], node[1])]
+				if name == None:
+					parents[-1].pop()
+				else:
+					node[0] = node[1] = name
+			node = parents.pop() if len(parents) > 0 else None
+		elif node == None:
+			return None
+		else:
+			node.append(token)
+	if root == None or node != None:
+		return None
+	return root
+
+_labelIds = dict() #label -> id
+_labelNames = [] #id -> label
+
+#returns the id of label, assigning it one if it doesn't have one yet
+def internLabel(label):
+	i = _labelIds.get(label)
+	if i == None:
+		i = len(_labelNames)
+		_labelIds[label] = i
+		_labelNames.append(label)
+	return i
+
+class _TreeArrays:
+	__slots__ = ['labels', 'words', 'ends', 'cache']
+
+	def __init__(self, labels, words, ends):
+		self.labels = array('i', labels)
+		self.words = words
+		self.ends = array('i', ends)
+		self.cache = dict() #(index of a node, key) -> value
+
+class ConstituencyTree:
+	__slots__ = ['_arrays', '_root']
+
+	def __init__(self, arrays, root=0):
+		self._arrays = arrays
+		self._root = root
+
+	"""Returns the ConstituencyTree of T, a tree in the nested list format."""
+	@classmethod
+	def fromList(cls, T):
+		if isinstance(T, ConstituencyTree):
+			return T
+		labels = []
+		words = []
+		ends = []
+		def add(node):
+			i = len(labels)
+			if isinstance(node, str):
+				labels.append(-1)
+				words.append(node)
+				ends.append(i+1)
+				return
+			if len(node)==0 or not isinstance(node[0], str):
+				raise ValueError("Not a constituency tree node: " + str(node))
+			label = _labelIds.get(node[0])
+			labels.append(label if label != None else internLabel(node[0]))
+			words.append(None)
+			ends.append(0)
+			for c in node[1:]:
+				add(c)
+			ends[i] = len(labels)
+		add(T)
+		return cls(_TreeArrays(labels, words, ends))
+
+	"""Returns the tree in the nested list format. The lists are new, so they can be modified."""
+	def toList(self):
+		labels = self._arrays.labels
+		words = self._arrays.words
+		ends = self._arrays.ends
+		def build(i):
+			if labels[i] < 0:
+				return words[i]
+			toReturn = [_labelNames[labels[i]]]
+			j = i+1
+			while j < ends[i]:
+				toReturn.append(build(j))
+				j = ends[j]
+			return toReturn
+		return build(self._root)
+
+	@property
+	def label(self):
+		return _labelNames[self._arrays.labels[self._root]]
+
+	#returns the indices of the children of node i
+	def _children(self, i):
+		ends = self._arrays.ends
+		toReturn = []
+		j = i+1
+		while j < ends[i]:
+			toReturn.append(j)
+			j = ends[j]
+		return toReturn
+
+	#returns node i as it appears in the list format: a word, or a ConstituencyTree
+	def _node(self, i):
+		if self._arrays.labels[i] < 0:
+			return self._arrays.words[i]
+		return ConstituencyTree(self._arrays, i)
+
+	def __len__(self):
+		return 1 + len(self._children(self._root))
+
+	def __getitem__(self, k):
+		items = [self.label] + [self._node(i) for i in self._children(self._root)]
+		return items[k]
+
+	def __iter__(self):
+		yield self.label
+		for i in self._children(self._root):
+			yield self._node(i)
+
+	def __eq__(self, other):
+		if isinstance(other, ConstituencyTree):
+			other = other.toList()
+		return self.toList() == other
+
+	def __repr__(self):
+		return 'ConstituencyTree(' + str(self.toList()) + ')'
+
+	"""Returns the value stored for this tree under key, calling compute() to get it the first time."""
+	def cached(self, key, compute):
+		cache = self._arrays.cache
+		if (self._root, key) not in cache:
+			cache[(self._root, key)] = compute()
+		return cache[(self._root, key)]
+
+	"""Same as rewriteRules.getWordSequence() on the list format, as a tuple."""
+	def wordSequence(self):
+		def compute():
+			get = punctuationNames.get
+			return tuple([get(w, w) for w in self._arrays.words[self._root+1:self._arrays.ends[self._root]] if w != None])
+		return self.cached('wordSequence', compute)
+
+	"""Same as rewriteRules.getTagSequence() on the list format (including the exceptions it raises), as a tuple."""
+	def tagSequence(self):
+		def compute():
+			labels = self._arrays.labels
+			toReturn = []
+			def visit(i):
+				children = self._children(i)
+				if len(children)==0:
+					raise Exception("List found with no content or word:" + str(ConstituencyTree(self._arrays, i).toList()))
+				if len(children)==1 and labels[children[0]] < 0:
+					toReturn.append(_labelNames[labels[i]])
+					return
+				for j in children:
+					if labels[j] < 0:
+						raise Exception("getTagSequence() called on a string:" + self._arrays.words[j])
+					visit(j)
+			visit(self._root)
+			return tuple(toReturn)
+		return self.cached('tagSequence', compute)
+
+	"""Same as rewriteRules.getWordsByPOS(): the subtrees (in the list format) whose label is in posTags, not counting the
+	ones inside another such subtree."""
+	def wordsByPOS(self, posTags):
+		def compute():
+			labels = self._arrays.labels
+			ends = self._arrays.ends
+			ids = set(_labelIds[t] for t in posTags if t in _labelIds)
+			toReturn = []
+			end = ends[self._root]
+			i = self._root
+			while i < end:
+				if labels[i] in ids:
+					toReturn.append(i)
+					i = ends[i]
+				else:
+					i += 1
+			return toReturn
+		return [ConstituencyTree(self._arrays, i).toList() for i in self.cached(('wordsByPOS', tuple(posTags)), compute)]
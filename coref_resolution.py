@@ -1,58 +1,299 @@
+import bisect
 import json
 import traceback
 import sys
+import ast
+import atexit
+import threading
+import requests
+import re
+import os
+from concurrent.futures import ThreadPoolExecutor
 from stanfordnlp.server import CoreNLPClient
+from stanfordnlp.server.client import PermanentlyFailedException
+from snli_reader import iterSNLI, countPairs
 
-#Parses a coreference chain (must be a string of a SINGLE coref chain.) If C was returned
-#by stanfordnlp, you should pass str(C[i]) for i in range(len(C)).
+"""One mention of a coreference chain. Only the fields the server set are present, and they can be read like the keys of
+a dict (m['mentionType']), which is what parseCrc() used to return.
+"""
+class CorefMention:
+	__slots__ = ['mentionID', 'mentionType', 'number', 'gender', 'animacy', 'beginIndex', 'endIndex', 'headIndex', 'sentenceIndex', 'position']
+	_fields = frozenset(__slots__)
+
+	def __getitem__(self, key):
+		try:
+			return getattr(self, key)
+		except AttributeError:
+			raise KeyError(key)
+
+	def __setitem__(self, key, value):
+		if key not in self._fields:
+			raise KeyError(key)
+		setattr(self, key, value)
+
+	def __contains__(self, key):
+		return key in self._fields and hasattr(self, key)
+
+	def get(self, key, default=None):
+		return getattr(self, key, default) if key in self._fields else default
+
+	def keys(self):
+		return [k for k in self.__slots__ if hasattr(self, k)]
+
+	def toDict(self):
+		return {k:getattr(self, k) for k in self.keys()}
+
+	def __eq__(self, other):
+		return self.toDict() == (other.toDict() if isinstance(other, CorefMention) else other)
+
+	def __repr__(self):
+		return 'CorefMention(' + repr(self.toDict()) + ')'
+
+#parses the value of one line of a protobuf message's text format
+def _parseTextValue(v):
+	if v.startswith('"'):
+		return v[1:-1] if '\\' not in v else ast.literal_eval(v)
+	try:
+		return int(v)
+	except ValueError:
+		return v
+
+"""Parses a SINGLE coreference chain into a list of CorefMentions. crc can be one of the chains returned by stanfordnlp
+(ann.corefChain[i]), whose fields are read directly, or its text format (str(ann.corefChain[i])).
+"""
 def parseCrc(crc):
 	toReturn = []
-	thisMention = "{"
+	if not isinstance(crc, str):
+		for mention in crc.mention:
+			m = CorefMention()
+			for (field, value) in mention.ListFields():
+				if field.name in CorefMention._fields:
+					setattr(m, field.name, value)
+			toReturn.append(m)
+		return toReturn
+	m = None
 	for l in crc.split('\n'):
-		if l.strip()=="mention {" or l.strip()=='':
-			pass
-		elif l.strip()=='}':
-			thisMention += '}'
-# 			print("processing:\n", thisMention) 
-			toReturn.append(eval(thisMention))
-			thisMention = "{"
-		elif ':' in l:
-			l = l.strip()
-			thisMention += "'" + l[:l.index(':')] + "'" + l[l.index(':'):] + ', '
-		else:
-			print("Unrecognized (skipping):", l.strip())
+		l = l.strip()
+		if l=="mention {":
+			m = CorefMention()
+		elif l=='}':
+			if m != None:
+				toReturn.append(m)
+			m = None
+		elif ':' in l and m != None:
+			key = l[:l.index(':')]
+			if key in CorefMention._fields:
+				setattr(m, key, _parseTextValue(l[l.index(':')+1:].strip()))
+		elif l!='' and m != None:
+			print("Unrecognized (skipping):", l)
 	return toReturn
 
-def getCrc(s, coreNlpClient):
-	ann = coreNlpClient.annotate(s)
+def getCrc(s, coreNlpClient, annotators=None, properties=None):
+	ann = coreNlpClient.annotate(s, annotators=annotators, properties=properties)
 	return ann.corefChain
 
+corefBatchAnnotators = ['tokenize', 'ssplit', 'pos', 'lemma', 'ner', 'parse', 'coref']
+
+#annotates a batch of texts as one document (one text per line) and splits the chains back up by text. Each line is split
+#into sentences as it would be on its own: a line break always ends a sentence, but a line can still hold several sentences.
+def _getCrcBatch(batch, client):
+	lines = [s.replace('\n', ' ') for s in batch]
+	ann = client.annotate('\n'.join(lines), annotators=corefBatchAnnotators, properties={'ssplit.newlineIsSentenceBreak':'always'})
+	#the offset each line starts at (CoreNLP counts UTF-16 code units), and the line each sentence of the document is in
+	lineStarts = []
+	offset = 0
+	for line in lines:
+		lineStarts.append(offset)
+		offset += len(line.encode('utf-16-le'))//2 + 1
+	sentenceLines = [bisect.bisect_right(lineStarts, sentence.token[0].beginChar) - 1 for sentence in ann.sentence]
+	if sorted(set(sentenceLines)) != list(range(len(batch))):
+		#some line didn't get a sentence of its own (e.g. an empty one), so the chains can't be mapped back. Do them one by one.
+		return [[parseCrc(chain) for chain in getCrc(s, client, annotators=corefBatchAnnotators)] for s in batch]
+	firstSentences = [sentenceLines.index(l) for l in range(len(batch))] #the index in the document of the first sentence of each line
+	toReturn = [[] for s in batch]
+	for chain in ann.corefChain:
+		mentions = parseCrc(chain)
+		byLine = dict()
+		for m in mentions:
+			byLine.setdefault(sentenceLines[m['sentenceIndex']], []).append(m)
+		for (line, part) in byLine.items():
+			if len(part) < 2 and len(byLine) > 1:
+				continue #only linked to mentions in other lines of the batch, which aren't related to this text
+			for m in part:
+				m['sentenceIndex'] -= firstSentences[line]
+			toReturn[line].append(part)
+	return toReturn
+
+"""Returns the coreference chains (each one a list of mentions, as returned by parseCrc) of every sentence in sentences.
+Sentences are sent to the server batchSize at a time, packed into one document with one sentence per line, and up to
+numThreads batches are annotated concurrently. A sentence that the server splits in several (e.g. "A man runs. He is fast.")
+is split the same way as when it is annotated on its own, so its mentions' sentenceIndex is the same too. Links the server
+makes between different lines of a batch are dropped, so each sentence only gets the chains within itself. Note that since the coref system sees the whole batch, this can
+occasionally give slightly different chains than annotating each sentence on its own.
+"""
+def getCrcBatch(sentences, client=None, batchSize=50, numThreads=4):
+	if client == None:
+		client = getCoreNLPClient()
+	batches = [sentences[i:i+batchSize] for i in range(0, len(sentences), batchSize)]
+	with ThreadPoolExecutor(max_workers=numThreads) as executor:
+		results = list(executor.map(lambda batch: _getCrcBatch(batch, client), batches))
+	return [chains for result in results for chains in result]
+
+"""Joins a list of tokens the same way R2 does before sending them to the server. Precomputed chains are looked up by this text."""
+def tokensToText(tokens):
+	return ' '.join(tokens).replace(' .', '.')
+
+precomputedChains = dict() #text -> list of chains. An empty list means the text is known to have no chains.
+
+"""Loads a file written by precomputeChains(). R2 looks sentences up in it before asking the server."""
+def loadPrecomputedChains(path):
+	if not os.path.exists(path):
+		return
+	with open(path, 'r') as F:
+		for line in F:
+			if line.strip()=='':
+				continue
+			entry = json.loads(line)
+			precomputedChains[entry['original_line']] = entry['chains']
+
+"""Returns the precomputed chains of text, or None if it wasn't precomputed."""
+def lookupChains(text):
+	return precomputedChains.get(text)
+
+"""Computes the chains of every text in texts (with getCrcBatch) and appends them to path, including the ones with no chains."""
+def precomputeChains(texts, path, client=None, batchSize=50, numThreads=4):
+	texts = [t for t in dict.fromkeys(texts) if t not in precomputedChains]
+	allChains = getCrcBatch(texts, client, batchSize, numThreads)
+	with open(path, 'a') as F:
+		for (text, chains) in zip(texts, allChains):
+			precomputedChains[text] = chains
+			F.write(json.dumps({'original_line':text, 'chains':[[m.toDict() for m in chain] for chain in chains]}) + '\n')
+
+"""A connection to an already running CoreNLP server that is kept open and reused, instead of creating (and starting up)
+a new CoreNLPClient for every request. If the server drops the connection or stops responding, the underlying client is
+recreated and the request is retried (up to `retries` times). Safe to share between threads.
+"""
+class SharedCoreNLPClient:
+	def __init__(self, endpoint, retries=1):
+		self.endpoint = endpoint
+		self.retries = retries
+		self.lock = threading.Lock()
+		self.client = None
+
+	def _getClient(self):
+		with self.lock:
+			if self.client == None:
+				#start_server=False: only connect to the server, never try to launch one
+				self.client = CoreNLPClient(endpoint=self.endpoint, start_server=False)
+			return self.client
+
+	def _reconnect(self, failedClient):
+		with self.lock:
+			if self.client is failedClient: #another thread may have already reconnected
+				try:
+					failedClient.stop()
+				except Exception:
+					pass
+				self.client = None
+
+	"""Same as CoreNLPClient.annotate(). annotators=None uses the server's default annotators."""
+	def annotate(self, text, annotators=None, properties=None):
+		attempt = 0
+		while True:
+			client = self._getClient()
+			try:
+				if properties != None:
+					return client.annotate(text, annotators=annotators, properties=properties)
+				if annotators == None:
+					return client.annotate(text)
+				return client.annotate(text, annotators=annotators)
+			except (requests.exceptions.ConnectionError, PermanentlyFailedException):
+				if attempt >= self.retries:
+					raise
+				attempt += 1
+				self._reconnect(client)
+
+	def close(self):
+		with self.lock:
+			if self.client != None:
+				try:
+					self.client.stop()
+				except Exception:
+					pass
+				self.client = None
+
+_sharedClients = dict() #endpoint -> SharedCoreNLPClient
+_sharedClientsLock = threading.Lock()
+
+"""Returns the SharedCoreNLPClient for endpoint, creating it the first time it is asked for. Every client created this way
+is closed when the program exits."""
+def getCoreNLPClient(endpoint="http://localhost:9000"):
+	with _sharedClientsLock:
+		if endpoint not in _sharedClients:
+			_sharedClients[endpoint] = SharedCoreNLPClient(endpoint)
+		return _sharedClients[endpoint]
+
+def closeCoreNLPClients():
+	with _sharedClientsLock:
+		for client in _sharedClients.values():
+			client.close()
+		_sharedClients.clear()
+
+atexit.register(closeCoreNLPClients)
+
 """EXAMPLE:
 
-with CoreNLPClient(endpoint="http://localhost:9000") as client:
-	crc = getCrc("John loves his wife. She has flowers for him.", client)
-	chains = [parseCrc(str(chain)) for chain in crc]
+client = getCoreNLPClient("http://localhost:9000")
+crc = getCrc("John loves his wife. She has flowers for him.", client)
+chains = [parseCrc(chain) for chain in crc]
 """
 
+"""Usage:
+python coref_resolution.py
+	writes the chains of every SNLI sentence that has any to all_crc_chains.txt
+python coref_resolution.py precompute [output file]
+	writes the chains of every SNLI sentence, as R2 will see it (after R9, R1 and R4-R8, see run_S3.applyRulesBeforeR2), to
+	the output file (default: crc_precomputed.jsonl), in batches. R2 reads it if rewriteRules.precomputedChainsLocation
+	points to it.
+"""
 if __name__=="__main__":
 	SNLI_LOCATION = "snli/snli_1.0_dev.txt"
-	with open(SNLI_LOCATION, 'r') as F:
-		allLines = [l.strip().split('\t') for l in F.readlines()[1:]]
+	numPairs = countPairs(SNLI_LOCATION)
 	
-	with CoreNLPClient(endpoint="http://localhost:9000") as client:
-		for (i,line) in enumerate(allLines):
-			if i%100==0:
-				print("On line", i, "of", len(allLines))		
-			for S in [line[5],line[6]]:
+	if len(sys.argv)>1 and sys.argv[1]=='precompute':
+		outputPath = sys.argv[2] if len(sys.argv)>2 else "crc_precomputed.jsonl"
+		from run_S3 import cleanConstituency, applyRulesBeforeR2
+		from rewriteRules import parseConstituency, getR2Text
+		loadPrecomputedChains(outputPath)
+		texts = []
+		for (i,pair) in enumerate(iterSNLI(SNLI_LOCATION)):
+			for parse in [pair.sentence1_parse, pair.sentence2_parse]:
 				try:
-					crc = getCrc(S, client)
-					chains = [parseCrc(str(chain)) for chain in crc]
-					if len(chains)==0:
-						continue
-					thisEntry = {'original_line':S, 'chains':chains}
-					with open("all_crc_chains.txt", 'a') as F:
-						F.write(json.dumps(thisEntry) + '\n')
-				except:
-					print("ERROR on line", i)
-					traceback.print_exc(file=sys.stdout)
-					exit()
\ No newline at end of file
+					texts.append(getR2Text(applyRulesBeforeR2(parseConstituency(cleanConstituency(parse)), None)))
+				except Exception:
+					pass #R2 can't handle it either, so it never looks it up
+			if len(texts) >= 2000 or i==numPairs-1:
+				print("On line", i, "of", numPairs)
+				precomputeChains(texts, outputPath)
+				texts = []
+		exit()
+	client = getCoreNLPClient("http://localhost:9000")
+	sentences = []
+	for (i,pair) in enumerate(iterSNLI(SNLI_LOCATION)):
+		sentences += [pair.sentence1, pair.sentence2]
+		if len(sentences) < 2000 and i < numPairs-1:
+			continue
+		print("On line", i, "of", numPairs)
+		try:
+			allChains = getCrcBatch(sentences, client)
+		except:
+			print("ERROR on the batch ending at line", i)
+			traceback.print_exc(file=sys.stdout)
+			exit()
+		with open("all_crc_chains.txt", 'a') as F:
+			for (S, chains) in zip(sentences, allChains):
+				if len(chains)==0:
+					continue
+				thisEntry = {'original_line':S, 'chains':[[m.toDict() for m in chain] for chain in chains]}
+				F.write(json.dumps(thisEntry) + '\n')
+		sentences = []
@@ -0,0 +1,211 @@
+"""
+Counters and histograms of what a run of run_S3.py has done so far (how many problems it solved, at which stage, how long
+each stage took, ...). They are cheap enough to update for every problem, and can be written out as JSON snapshots and merged,
+e.g. the metrics of the chunks solved by the workers of a parallel run, or the last snapshots of several shards.
+
+A snapshot (Metrics.toJSON()) is a dict {name: metric}, where a metric is one of
+	{'type':'counter', 'value':number}
+	{'type':'labeledCounter', 'labels':[...], 'values':[...]}
+	{'type':'histogram', 'bounds':[...], 'counts':[...], 'count':number, 'sum':number, 'min':number, 'max':number}
+where counts[i] is the number of values v with bounds[i-1] < v <= bounds[i] (the last one counts the values above all bounds).
+
+Running `python metrics.py summary FILE ...` merges the last snapshot in each of the given files (e.g. the _metrics.jsonl files
+of several shards) and prints a summary of it.
+"""
+import bisect
+import json
+import os
+import sys
+
+#the default bounds of a histogram, for latencies in seconds: 1ms to 100s, roughly 3 per power of 10
+latencyBounds = [m*10**e for e in range(-3, 2) for m in [1, 2, 5]] + [100]
+
+class Counter:
+	__slots__ = ['value']
+
+	def __init__(self):
+		self.value = 0
+
+	def inc(self, n=1):
+		self.value += n
+
+	def merge(self, other):
+		self.value += other.value
+
+	def toJSON(self):
+		return {'type':'counter', 'value':self.value}
+
+	def summary(self):
+		return self.value
+
+"""A counter for each of a fixed list of labels, e.g. the stages problems were solved at."""
+class LabeledCounter:
+	__slots__ = ['labels', 'values']
+
+	def __init__(self, labels):
+		self.labels = list(labels)
+		self.values = dict.fromkeys(self.labels, 0)
+
+	def add(self, label, n=1):
+		self.values[label] += n
+
+	def merge(self, other):
+		for [label, n] in other.values.items():
+			self.values[label] = self.values.get(label, 0) + n
+			if label not in self.labels:
+				self.labels.append(label)
+
+	def toJSON(self):
+		return {'type':'labeledCounter', 'labels':self.labels, 'values':[self.values[l] for l in self.labels]}
+
+	def summary(self):
+		return dict(self.values)
+
+"""Counts the values it is given in buckets, with the upper bounds given (in increasing order)."""
+class Histogram:
+	__slots__ = ['bounds', 'counts', 'count', 'sum', 'min', 'max']
+
+	def __init__(self, bounds=latencyBounds):
+		self.bounds = list(bounds)
+		self.counts = [0]*(len(self.bounds)+1)
+		self.count = 0
+		self.sum = 0
+		self.min = None
+		self.max = None
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.bounds, value)] += 1
+		self.count += 1
+		self.sum += value
+		if self.min == None or value < self.min:
+			self.min = value
+		if self.max == None or value > self.max:
+			self.max = value
+
+	def merge(self, other):
+		if other.bounds != self.bounds:
+			raise ValueError("Can't merge histograms with different bounds")
+		for i in range(len(self.counts)):
+			self.counts[i] += other.counts[i]
+		self.count += other.count
+		self.sum += other.sum
+		if other.min != None and (self.min == None or other.min < self.min):
+			self.min = other.min
+		if other.max != None and (self.max == None or other.max > self.max):
+			self.max = other.max
+
+	"""Returns an estimate of the q-quantile (0 <= q <= 1) of the values: the upper bound of the bucket it falls in (or the
+	largest value, if that is smaller or it is above all bounds). None if there are no values."""
+	def quantile(self, q):
+		if self.count == 0:
+			return None
+		seen = 0
+		for i in range(len(self.counts)):
+			seen += self.counts[i]
+			if seen >= q*self.count and seen > 0:
+				return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+		return self.max
+
+	def toJSON(self):
+		return {'type':'histogram', 'bounds':self.bounds, 'counts':self.counts, 'count':self.count, 'sum':self.sum, 'min':self.min, 'max':self.max}
+
+	def summary(self):
+		return {'count':self.count, 'mean':self.sum/self.count if self.count > 0 else None, 'p50':self.quantile(0.5),
+			'p90':self.quantile(0.9), 'p99':self.quantile(0.99), 'max':self.max}
+
+class Metrics:
+	def __init__(self):
+		self.metrics = dict() #name -> Counter, LabeledCounter or Histogram, in the order they were added
+
+	def counter(self, name):
+		if name not in self.metrics:
+			self.metrics[name] = Counter()
+		return self.metrics[name]
+
+	def labeledCounter(self, name, labels):
+		if name not in self.metrics:
+			self.metrics[name] = LabeledCounter(labels)
+		return self.metrics[name]
+
+	def histogram(self, name, bounds=latencyBounds):
+		if name not in self.metrics:
+			self.metrics[name] = Histogram(bounds)
+		return self.metrics[name]
+
+	def __getitem__(self, name):
+		return self.metrics[name]
+
+	def __contains__(self, name):
+		return name in self.metrics
+
+	"""Adds the values of other (a Metrics) to these. Metrics only other has are added too."""
+	def merge(self, other):
+		for [name, metric] in other.metrics.items():
+			if name in self.metrics:
+				self.metrics[name].merge(metric)
+			else:
+				self.metrics[name] = Metrics.metricFromJSON(metric.toJSON())
+
+	def toJSON(self):
+		return {name:metric.toJSON() for [name, metric] in self.metrics.items()}
+
+	"""Returns the values of the counters, and the count, mean and some quantiles of the histograms."""
+	def summary(self):
+		return {name:metric.summary() for [name, metric] in self.metrics.items()}
+
+	@staticmethod
+	def metricFromJSON(d):
+		if d['type']=='counter':
+			metric = Counter()
+			metric.value = d['value']
+		elif d['type']=='labeledCounter':
+			metric = LabeledCounter(d['labels'])
+			metric.values = dict(zip(d['labels'], d['values']))
+		elif d['type']=='histogram':
+			metric = Histogram(d['bounds'])
+			metric.counts = list(d['counts'])
+			for k in ['count', 'sum', 'min', 'max']:
+				setattr(metric, k, d[k])
+		else:
+			raise ValueError("Unknown type of metric: " + str(d['type']))
+		return metric
+
+	"""Returns the Metrics of a snapshot returned by toJSON()."""
+	@classmethod
+	def fromJSON(cls, d):
+		toReturn = cls()
+		for [name, metric] in d.items():
+			toReturn.metrics[name] = Metrics.metricFromJSON(metric)
+		return toReturn
+
+"""Appends snapshot (a JSON serializable dict) as a line to the file at path, in a single write."""
+def appendSnapshot(path, snapshot):
+	fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+	try:
+		os.write(fd, (json.dumps(snapshot) + '\n').encode('utf-8'))
+	finally:
+		os.close(fd)
+
+"""Returns the last snapshot in the file at path (written by appendSnapshot()), or None if it has none."""
+def lastSnapshot(path):
+	last = None
+	with open(path, 'r') as F:
+		for line in F:
+			if line.strip() != '':
+				last = line
+	return json.loads(last) if last != None else None
+
+"""Merges the metrics of the last snapshot in each of the files in paths. key = where the metrics are in a snapshot."""
+def mergeLastSnapshots(paths, key='metrics'):
+	total = Metrics()
+	for path in paths:
+		snapshot = lastSnapshot(path)
+		if snapshot != None:
+			total.merge(Metrics.fromJSON(snapshot[key]))
+	return total
+
+if __name__=="__main__":
+	if len(sys.argv) > 2 and sys.argv[1]=='summary':
+		print(json.dumps(mergeLastSnapshots(sys.argv[2:]).summary(), indent=1))
+	else:
+		print("Usage: python metrics.py summary FILE ...")
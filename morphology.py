@@ -0,0 +1,123 @@
+"""
+Cached versions of pattern.en's conjugate(), singularize() and pluralize(), which the rewrite rules call over and over on
+the same few thousand SNLI words.
+
+Results are kept in bounded LRU caches. In addition, a table of precomputed results can be built from the SNLI vocabulary
+(`python morphology.py build [SNLI files...]`) and saved to morphologyTableLocation; it is loaded the first time one of the
+functions is called. pattern itself is only imported when a word isn't in the table, so a run whose vocabulary is fully
+covered never pays for importing it.
+"""
+from collections import OrderedDict
+import json
+import os
+import re
+import sys
+
+morphologyTableLocation = "morphology_table.json" #built by `python morphology.py build`. Set to None to not use a table.
+morphologyCacheSize = 50000 #maximum number of results of each function kept in memory
+
+#the forms of conjugate() that the rewrite rules use, which are the ones precomputed in the table
+tableForms = ['inf', '3sg', '3pl', 'pl']
+
+_pattern = None
+def _patternEn():
+	global _pattern
+	if _pattern == None:
+		import pattern.en
+		_pattern = pattern.en
+	return _pattern
+
+_table = None #{'conjugate': {word + '\t' + form: result}, 'singularize': {word: result}, 'pluralize': {word: result}}
+def _getTable():
+	global _table
+	if _table == None:
+		_table = {'conjugate':dict(), 'singularize':dict(), 'pluralize':dict()}
+		if morphologyTableLocation != None and os.path.exists(morphologyTableLocation):
+			with open(morphologyTableLocation, 'r') as F:
+				_table.update(json.load(F))
+	return _table
+
+_caches = {'conjugate':OrderedDict(), 'singularize':OrderedDict(), 'pluralize':OrderedDict()}
+
+#looks key up in the table and the LRU cache of function name, calling compute() if it's in neither
+def _lookup(name, key, compute):
+	table = _getTable()[name]
+	if isinstance(key, str) and key in table:
+		return table[key]
+	cache = _caches[name]
+	if key in cache:
+		cache.move_to_end(key)
+		return cache[key]
+	value = compute()
+	cache[key] = value
+	if len(cache) > morphologyCacheSize:
+		cache.popitem(last=False)
+	return value
+
+"""Same as pattern.en.conjugate(). Calls of the form conjugate(verb, form) are looked up in the table."""
+def conjugate(verb, *args, **kwargs):
+	if len(args)==1 and len(kwargs)==0 and isinstance(args[0], str):
+		key = verb + '\t' + args[0]
+	else:
+		key = (verb, args, tuple(sorted(kwargs.items())))
+	return _lookup('conjugate', key, lambda: _patternEn().conjugate(verb, *args, **kwargs))
+
+"""Same as pattern.en.singularize()."""
+def singularize(word, *args, **kwargs):
+	key = word if len(args)==0 and len(kwargs)==0 else (word, args, tuple(sorted(kwargs.items())))
+	return _lookup('singularize', key, lambda: _patternEn().singularize(word, *args, **kwargs))
+
+"""Same as pattern.en.pluralize()."""
+def pluralize(word, *args, **kwargs):
+	key = word if len(args)==0 and len(kwargs)==0 else (word, args, tuple(sorted(kwargs.items())))
+	return _lookup('pluralize', key, lambda: _patternEn().pluralize(word, *args, **kwargs))
+
+"""Returns [verbs, nouns]: the sets of words tagged as verbs and nouns in the constituency parses of the SNLI files in paths,
+in their original and lowercase forms.
+"""
+def snliVocabulary(paths):
+	from snli_reader import iterSNLI
+	verbs = set()
+	nouns = set()
+	for path in paths:
+		for pair in iterSNLI(path):
+			for parse in [pair.sentence1_parse, pair.sentence2_parse]:
+				for (tag, word) in re.findall(r'\(([^()\s]+) ([^()\s]+)\)', parse):
+					if tag.startswith('VB'):
+						verbs.update([word, word.lower()])
+					elif tag.startswith('NN'):
+						nouns.update([word, word.lower()])
+	return [verbs, nouns]
+
+"""Computes the conjugations (in all of tableForms, also of each verb's infinitive) of every verb, and the singular and plural
+of every noun in the vocabulary of the SNLI files in paths, and saves them to path.
+"""
+def buildMorphologyTable(paths, path):
+	[verbs, nouns] = snliVocabulary(paths)
+	en = _patternEn()
+	table = {'conjugate':dict(), 'singularize':dict(), 'pluralize':dict()}
+	for v in sorted(verbs):
+		infinitive = en.conjugate(v, 'inf')
+		for w in [v, infinitive, infinitive.lower() if infinitive != None else None]:
+			if w == None:
+				continue
+			for form in tableForms:
+				table['conjugate'][w + '\t' + form] = en.conjugate(w, form)
+	for n in sorted(nouns):
+		singular = en.singularize(n)
+		for w in [n, singular, singular.lower()]:
+			table['singularize'][w] = en.singularize(w)
+			table['pluralize'][w] = en.pluralize(w)
+	tmp = path + '.tmp'
+	with open(tmp, 'w') as F:
+		json.dump(table, F)
+	os.replace(tmp, path)
+	return table
+
+if __name__=="__main__":
+	if len(sys.argv)>1 and sys.argv[1]=='build':
+		paths = sys.argv[2:] if len(sys.argv)>2 else ["snli/snli_1.0_train.txt", "snli/snli_1.0_dev.txt", "snli/snli_1.0_test.txt"]
+		paths = [p for p in paths if os.path.exists(p)]
+		print("Building morphology table from", paths, "...")
+		table = buildMorphologyTable(paths, morphologyTableLocation)
+		print("Done:", {k:len(v) for (k,v) in table.items()}, "entries.")
@@ -0,0 +1,81 @@
+"""
+A small on-disk record of which SNLI problems a run of run_S3.py has finished, so that a process that was stopped (or killed)
+can be restarted and carry on from where it was, without reading its earlier outputs or the problems it already solved.
+
+A journal covers the problems with index start <= i < stop. It holds firstIncomplete (every problem before it is done), a
+bitmap with one bit per problem (1 = done) for the ones that were done out of order, and state, a dict of whatever else the
+caller needs to resume (e.g. its counters), which must be JSON serializable. save() writes all of it to a temporary file and
+renames it over the journal, so after a crash the journal is either the one from the last save() or the one before it, never
+a mix of the two.
+
+The file is one line of JSON with everything but the bitmap, followed by the bitmap's bytes.
+"""
+import json
+import os
+
+class ProgressJournal:
+	"""Loads the journal at path if it exists (it must have been made for the same start and stop), or starts an empty one."""
+	def __init__(self, path, start, stop):
+		self.path = path
+		self.start = start
+		self.stop = stop
+		self.firstIncomplete = start
+		self.numDone = 0
+		self.state = dict()
+		self.bitmap = bytearray((stop - start + 7)//8)
+		if os.path.exists(path):
+			self._load()
+
+	def _load(self):
+		with open(self.path, 'rb') as F:
+			header = json.loads(F.readline().decode('utf-8'))
+			bitmap = F.read()
+		if header['start'] != self.start or header['stop'] != self.stop or len(bitmap) != len(self.bitmap):
+			raise ValueError("The progress journal " + self.path + " is for problems " + str(header['start']) + " to " +
+				str(header['stop']) + ", not " + str(self.start) + " to " + str(self.stop) + ". Delete it to start over.")
+		self.bitmap = bytearray(bitmap)
+		self.firstIncomplete = header['firstIncomplete']
+		self.numDone = header['numDone']
+		self.state = header['state']
+
+	def isDone(self, i):
+		i -= self.start
+		return (self.bitmap[i >> 3] >> (i & 7)) & 1 == 1
+
+	def isComplete(self):
+		return self.firstIncomplete >= self.stop
+
+	"""Marks the problems with the given indices as done. Like the state, this is only written to disk by save()."""
+	def markDone(self, indices):
+		for i in indices:
+			if not self.isDone(i):
+				j = i - self.start
+				self.bitmap[j >> 3] |= 1 << (j & 7)
+				self.numDone += 1
+		while self.firstIncomplete < self.stop and self.isDone(self.firstIncomplete):
+			self.firstIncomplete += 1
+
+	"""Atomically replaces the journal on disk with the current one."""
+	def save(self):
+		header = {'start':self.start, 'stop':self.stop, 'firstIncomplete':self.firstIncomplete, 'numDone':self.numDone, 'state':self.state}
+		tmp = self.path + '.tmp'
+		with open(tmp, 'wb') as F:
+			F.write(json.dumps(header).encode('utf-8') + b'\n')
+			F.write(self.bitmap)
+			F.flush()
+			os.fsync(F.fileno())
+		os.replace(tmp, self.path)
+		#make sure the rename itself is on disk (not possible on every platform, e.g. Windows)
+		try:
+			fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+			try:
+				os.fsync(fd)
+			finally:
+				os.close(fd)
+		except OSError:
+			pass
+
+	"""Deletes the journal from disk."""
+	def remove(self):
+		if os.path.exists(self.path):
+			os.remove(self.path)
@@ -0,0 +1,76 @@
+"""
+Buffered writers for the output files of run_S3.py. Instead of opening and appending to a file for every line, a ResultSink
+keeps the lines of each kind of output in memory and appends them in one write() per file when it is flushed: after
+flushEvery lines, when flushInterval seconds have passed, or when flush() / checkpoint() is called. Lines are only ever
+written whole, so processes appending to the same file can't interleave partial lines. checkpoint() also fsyncs the files,
+so everything written before it survives a crash.
+
+Optionally, every line is also written as a JSON object (with a "kind" field, and one field per column) to a single JSONL
+file, which is easier to load than the separate tab-separated files.
+"""
+import json
+import os
+import time
+
+class ResultSink:
+	"""pathOf(kind) = the file lines of that kind are appended to.
+	columns = {kind: names of the fields of its lines}, used for the JSONL output (fields of kinds not in it are called
+	field0, field1, ...).
+	jsonlPath = where to write the JSONL output, or None to not write it.
+	"""
+	def __init__(self, pathOf, columns=dict(), jsonlPath=None, flushEvery=200, flushInterval=30):
+		self.pathOf = pathOf
+		self.columns = columns
+		self.jsonlPath = jsonlPath
+		self.flushEvery = flushEvery
+		self.flushInterval = flushInterval
+		self.pending = dict() #path -> lines not written yet
+		self.numPending = 0
+		self.lastFlush = time.time()
+		self.files = dict() #path -> file descriptor, opened for appending
+
+	"""Adds a line with the tab-separated fields to the output of kind. strip=True strips whitespace from both ends of the line."""
+	def write(self, kind, fields, strip=False):
+		line = '\t'.join(fields)
+		if strip:
+			line = line.strip()
+		self._add(self.pathOf(kind), line + '\n')
+		if self.jsonlPath != None:
+			names = self.columns.get(kind, ['field' + str(i) for i in range(len(fields))])
+			record = {'kind':kind}
+			record.update(zip(names, fields))
+			self._add(self.jsonlPath, json.dumps(record, default=str) + '\n')
+		if self.numPending >= self.flushEvery or time.time() - self.lastFlush >= self.flushInterval:
+			self.flush()
+
+	def _add(self, path, line):
+		if path not in self.pending:
+			self.pending[path] = []
+		self.pending[path].append(line)
+		self.numPending += 1
+
+	"""Appends all pending lines to their files."""
+	def flush(self):
+		for (path, lines) in self.pending.items():
+			if len(lines)==0:
+				continue
+			if path not in self.files:
+				self.files[path] = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+			data = ''.join(lines).encode('utf-8')
+			while len(data) > 0:
+				data = data[os.write(self.files[path], data):]
+			lines.clear()
+		self.numPending = 0
+		self.lastFlush = time.time()
+
+	"""Flushes, and makes sure what was written is on disk."""
+	def checkpoint(self):
+		self.flush()
+		for fd in self.files.values():
+			os.fsync(fd)
+
+	def close(self):
+		self.checkpoint()
+		for fd in self.files.values():
+			os.close(fd)
+		self.files = dict()
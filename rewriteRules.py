@@ -6,8 +6,9 @@ Author: John Licato, licato@usf.edu
 from FOL_resolution import parseExpression, propStructToSExp
 import sys
 import re
-from pattern.en import conjugate, pluralize, singularize
-from wordnet_utils import findHypernym, findHypernym_onedir
+from morphology import conjugate, pluralize, singularize #cached wrappers around pattern.en's functions
+from wordnet_utils import findHypernym, findHypernym_onedir, hypernymMatrix
+from constituency_tree import ConstituencyTree, parsePennTree, punctuationNames
 """To install pattern:
 git clone -b development https://github.com/clips/pattern
 cd pattern
@@ -17,16 +18,56 @@ https://www.clips.uantwerpen.be/pages/pattern-en"""
 import stanfordnlp
 import traceback
 import copy
+from collections import OrderedDict
 
 coreNlpPort = 9000
+#annotators R2 asks the CoreNLP server for. 'parse' is included so the constituency parse comes back together with the
+#coreference chains, and can often be reused instead of sending the rewritten sentence back to be parsed again.
+corefAnnotators = ['tokenize', 'ssplit', 'pos', 'lemma', 'ner', 'parse', 'coref']
+precomputedChainsLocation = None #a file written by `python coref_resolution.py precompute`. R2 looks sentences up there before asking the server.
 
-#converts a constituency tree formatted as S-expression into a nested list structure.
+parseCacheSize = 1000 #number of strings parseConstituency() keeps the parses of, so the same sentence parsed again (e.g. in stage 3) is free
+_parsedConstituencies = OrderedDict() #string -> its tree, least recently used first. Only copies of these are handed out.
+pennTreeChecks = 1000 #number of strings that are also parsed with parseExpression(), to check that parsePennTree() gives the same tree
+usePennTree = True #set to False when one of those checks fails
+
+"""Converts a constituency tree formatted as S-expression into a nested list structure.
+The string is parsed by constituency_tree.parsePennTree(), or by parseConstituencyWithParseExpression() if that can't handle
+it. The result is new lists each time, so it can be modified, even when the parse itself comes from the cache.
+"""
 def parseConstituency(s):
+	if s in _parsedConstituencies:
+		_parsedConstituencies.move_to_end(s)
+		return copyTree(_parsedConstituencies[s])
+	T = parseConstituencyUncached(s)
+	_parsedConstituencies[s] = copyTree(T)
+	if len(_parsedConstituencies) > parseCacheSize:
+		_parsedConstituencies.popitem(last=False)
+	return T
+
+def parseConstituencyUncached(s):
+	global pennTreeChecks, usePennTree
+	T = parsePennTree(s) if usePennTree else None
+	if T == None:
+		return parseConstituencyWithParseExpression(s)
+	if pennTreeChecks > 0:
+		pennTreeChecks -= 1
+		expected = parseConstituencyWithParseExpression(s)
+		if T != expected:
+			print("parsePennTree() and parseExpression() disagree on", s, "- using parseExpression() from now on")
+			usePennTree = False
+			return expected
+	return T
+
+#how parseConstituency() used to work, and still does for the strings parsePennTree() doesn't take
+def parseConstituencyWithParseExpression(s):
 	s = s.replace("(. .)", "(PERIOD PERIOD)").replace("(? ?)", "(QUESTIONMARK QUESTIONMARK)").replace("(! !)", "(EXCLAMATION EXCLAMATION)")
 	s = s.replace("(, ,)", "").replace("(, ;)", "")
 	return parseExpression(s)
 
 def getTagSequence(T):
+	if isinstance(T, ConstituencyTree):
+		return list(T.tagSequence())
 	if isinstance(T, str):
 		raise Exception("getTagSequence() called on a string:" + T)
 	if len(T)<2:
@@ -40,13 +81,10 @@ def getTagSequence(T):
 	return toReturn
 
 def getWordSequence(T):
+	if isinstance(T, ConstituencyTree):
+		return list(T.wordSequence())
 	if isinstance(T, str):
-		punctuation_names = ['PERIOD', 'QUESTIONMARK', 'EXCLAMATION']
-		punctuations = ['.', '?', '!']
-		if T in punctuation_names:
-			return [punctuations[punctuation_names.index(T)]]
-		else:
-			return [T]
+		return [punctuationNames.get(T, T)]
 	if len(T)==0:
 		raise Exception("Zero argument list found:" + str(T))
 	toReturn = []
@@ -54,8 +92,14 @@ def getWordSequence(T):
 		toReturn += getWordSequence(w)
 	return toReturn
 
+#T can also be a ConstituencyTree, in which case the result is computed once and cached with it
 def treeToACEInput(T):
-	s = ' '.join(getWordSequence(T)).strip()
+	if isinstance(T, ConstituencyTree):
+		return T.cached('ACEInput', lambda: wordsToACEInput(T.wordSequence()))
+	return wordsToACEInput(getWordSequence(T))
+
+def wordsToACEInput(words):
+	s = ' '.join(words).strip()
 	# print("T:", T, "s:", s)
 	# if len(s)<2:
 	# 	print("ERROR:\n\tT was:", T, "\n\tgetWordSequence(T) was:", getWordSequence(T))
@@ -79,6 +123,8 @@ n = number of times the rule was applied, newT = the new tree.
 if recursive=False, then this only tries to apply the rule to the top node of the tree.
 """
 def applyRule(T, rule, recursive=True, snlp=None):
+	if isinstance(T, ConstituencyTree):
+		T = T.toList() #the rules modify and rebuild lists
 	# print("T is", T, "R is", rule)
 	[b, newT] = rule(T, snlp)
 	if not recursive:
@@ -97,7 +143,84 @@ def applyRule(T, rule, recursive=True, snlp=None):
 		else:
 			return [0, T]
 
+"""
+Applies several recursive rules to T, with the same result as calling applyRule(T, rule) for each of them in order, but in a
+single traversal of the tree. At each node, only the rules that can fire on it (according to recursiveRuleTargets) are tried,
+and a node's children only have the earlier rules applied to them when a later rule needs to look at the node. Subtrees in
+which nothing fires are shared with T rather than copied.
+Returns [counts, newT], where counts[i] = the number of times rules[i] was applied.
+If a rule raises an exception, so does this; in that case T may already have been partially modified (see R1).
+"""
+_ruleCandidates = dict() #tuple of rules -> kind of node -> label -> indices of the rules that can fire on such a node
+
+def applyRules(T, rules, snlp=None):
+	if isinstance(T, ConstituencyTree):
+		T = T.toList()
+	counts = [0]*len(rules)
+	targets = [recursiveRuleTargets.get(rule) for rule in rules]
+	key = tuple(rules)
+	if key not in _ruleCandidates:
+		_ruleCandidates[key] = {'preterminal':dict(), 'phrase':dict(), None:dict()}
+	candidates = _ruleCandidates[key]
 
+	def rulesFor(label, kind):
+		toReturn = [k for (k, t) in enumerate(targets) if t == None or t == kind or (isinstance(t, list) and label in t)]
+		candidates[kind][label] = toReturn
+		return toReturn
+
+	#applies rules[lo:hi] to T, as if each was applied to the whole tree with applyRule() in turn
+	def rewrite(T, lo, hi):
+		if len(T) < 2:
+			kind = None
+		elif isinstance(T[1], str):
+			kind = 'preterminal'
+		else:
+			kind = 'phrase'
+		label = T[0] if len(T)>0 else None
+		node = T
+		childLo = lo #the children of node have had rules[lo:childLo] applied to them
+		byLabel = candidates[kind]
+		for k in (byLabel[label] if label in byLabel else rulesFor(label, kind)):
+			if k < lo:
+				continue
+			if k >= hi:
+				break
+			#rule k has to see the node as it is after the rules before it were applied to the whole tree
+			if childLo < k:
+				node = rewriteChildren(node, childLo, k)
+				childLo = k
+			[b, newT] = rules[k](node, snlp)
+			if b:
+				counts[k] += 1
+				#applyRule() doesn't look inside a subtree a rule returned, but the later rules do
+				return newT if isinstance(newT, str) else rewrite(newT, k+1, hi)
+		if childLo < hi and (kind == 'phrase' or len(node) > 2):
+			node = rewriteChildren(node, childLo, hi)
+		return node
+
+	#applies rules[lo:hi] to the children of T. Returns T itself if none of them changed.
+	def rewriteChildren(T, lo, hi):
+		toReturn = None
+		for i in range(1, len(T)):
+			c = T[i]
+			if not isinstance(c, str):
+				newC = rewrite(c, lo, hi)
+				if newC is not c:
+					if toReturn == None:
+						toReturn = T[:]
+					toReturn[i] = newC
+		return T if toReturn == None else toReturn
+
+	newT = T if isinstance(T, str) else rewrite(T, 0, len(rules))
+	return [counts, newT]
+
+#returns a copy of T that shares nothing with it (except the strings). A ConstituencyTree is copied into the list format.
+def copyTree(T):
+	if isinstance(T, ConstituencyTree):
+		return T.toList()
+	if isinstance(T, str):
+		return T
+	return [copyTree(c) for c in T]
 
 """If there is a NP consisting of a sequence of JJs followed by a NN or NNS, then attach 'a:' to each JJ and 'n:' to the noun. These are markers that APE uses to identify words that may not be in its vocabulary. If there are multiple JJs, then make them an adjective phrase using conjunctions:
 (NP [(DT d)] (JJ adj1) (JJ adj2) ... (JJ adjn) (NN[S] n))
@@ -159,21 +282,64 @@ def R2_OLD(T, snlp=None):
 from coref_resolution import * #comment this out if not using R2
 import warnings
 warnings.filterwarnings("ignore") #comment this out if you want to see warnings
-"""New version of R2. This uses coreference resolution to find chains of coreferences, and then iteratively remove all pronominals.
-You must make sure that the stanfordnlp server is running at http://localhost:9000. (or whatever you chose for "coreNlpPort" above)
-Use the commands (on server, from within stanford nlp directory):
-export CORENLP_HOME=/home/licato/stanfordnlp_resources/stanford-corenlp-full-2018-10-05/stanford-corenlp-full-2018-10-05
-java -mx4g -cp "*" edu.stanford.nlp.pipeline.StanfordCoreNLPServer -port 9000 -timeout 15000 -preload coref 
-**If you use a port other than 9000, change it in the above command.
+#converts the funky format stanfordCoreNlp uses to the S-expression tree format we need
+def snlpToString(node): 
+	if len(node.child)==0:
+		return node.value.replace('xxjxx', ':')
+	toReturn = [node.value.replace('xxjxx', ':')]
+	for c in node.child:
+		toReturn.append(snlpToString(c))
+	return toReturn
 
-If this keeps outputting the "Starting Server with command..." line, go to (your virtualenv installation)/lib/python3.6/site-packages/stanfordnlp/server/client.py and comment out the print statement on line 118.
-This is NOT a recursive rule; if calling with applyRule(), use recursive=False.
+#merges the trees of several sentences under a single ROOT
+def mergeSentenceTrees(trees):
+	toReturn = ['ROOT']
+	for t in trees:
+		toReturn = toReturn + t[1:]
+	return toReturn
+
+"""Used by R2 when each of its edits replaced a single token with a single token. Takes the constituency parse that came back
+with the coreference chains (ann), and puts newWords in place of originalWords at its leaves. Pronouns that were replaced
+by a name are retagged as proper nouns. Returns None if the parse's leaves don't match originalWords (e.g. CoreNLP tokenized
+the sentence differently), in which case the rewritten sentence has to be parsed again.
 """
-def R2(T, snlp=None):
-	#first, go through and attach an index to each root node tag (so the list ['DT', 'the'], not the string 'the')
+def reuseParse(ann, originalWords, newWords):
+	trees = [snlpToString(s.parseTree) for s in ann.sentence]
+	preterminals = []
+	toCheck = list(trees)
+	while len(toCheck)>0:
+		curr = toCheck.pop(0)
+		if not isinstance(curr, list) or len(curr) < 2:
+			return None
+		if len(curr)==2 and isinstance(curr[1], str):
+			preterminals.append(curr)
+		else:
+			toCheck = curr[1:] + toCheck
+	if [p[1] for p in preterminals] != originalWords:
+		return None
+	for (p, old, new) in zip(preterminals, originalWords, newWords):
+		if new != old:
+			p[1] = new
+			if p[0] == 'PRP':
+				p[0] = 'NNP'
+	return mergeSentenceTrees(trees)
+
+_precomputedLoaded = False
+#the chains of text from precomputedChainsLocation, or None if it isn't there
+def lookupPrecomputedChains(text):
+	global _precomputedLoaded
+	if not _precomputedLoaded:
+		_precomputedLoaded = True
+		if precomputedChainsLocation != None:
+			loadPrecomputedChains(precomputedChainsLocation)
+	return lookupChains(text)
+
+"""Returns [the tokens of T as R2 sends them to the server, the APE label (like p or n) that was removed from each token, or
+None if it had none]. A final '.' is added if T doesn't end with one.
+"""
+def getR2Tokens(T):
 	outputSentence = []
 	outputLabels = [] #if we have APE labels, like p: or n:, save them here
-	T_backup = copy.deepcopy(T)
 	toCheck = [T]
 	#collect all of the tokens here. Remove all p:, n:, and a: tags and remember where they were for later.
 	while len(toCheck)>0:
@@ -184,7 +350,7 @@ def R2(T, snlp=None):
 			raise Exception("Unsure how to parse subtree:", curr)
 		elif isinstance(curr, list):
 			if len(curr) < 2:
-				raise Exception("R2 trying to parse improperly formed list:" + str(curr) + "\n\tOriginal sentence:" + str(T_backup))
+				raise Exception("R2 trying to parse improperly formed list:" + str(curr) + "\n\tOriginal sentence:" + str(T))
 			if isinstance(curr[1], str): #TODO: errors on this line (list index out of range)
 				if len(curr[1]) >= 2 and curr[1][1] == ':':
 					outputLabels.append(curr[1][0])
@@ -197,24 +363,50 @@ def R2(T, snlp=None):
 	if outputSentence[-1].strip() != ".":
 		outputSentence.append(".")
 		outputLabels.append(None)
+	return [outputSentence, outputLabels]
+
+#the text R2 annotates for tree T, which is what precomputed chains are looked up by
+def getR2Text(T):
+	return tokensToText(getR2Tokens(T)[0])
+
+"""New version of R2. This uses coreference resolution to find chains of coreferences, and then iteratively remove all pronominals.
+You must make sure that the stanfordnlp server is running at http://localhost:9000. (or whatever you chose for "coreNlpPort" above)
+Use the commands (on server, from within stanford nlp directory):
+export CORENLP_HOME=/home/licato/stanfordnlp_resources/stanford-corenlp-full-2018-10-05/stanford-corenlp-full-2018-10-05
+java -mx4g -cp "*" edu.stanford.nlp.pipeline.StanfordCoreNLPServer -port 9000 -timeout 15000 -preload coref 
+**If you use a port other than 9000, change it in the above command.
+
+R2 connects to the server through getCoreNLPClient() (see coref_resolution.py), so one connection is reused across calls
+and no new server is started for each request.
+This is NOT a recursive rule; if calling with applyRule(), use recursive=False.
+"""
+def R2(T, snlp=None):
+	#first, go through and attach an index to each root node tag (so the list ['DT', 'the'], not the string 'the')
+	T_backup = copy.deepcopy(T)
+	[outputSentence, outputLabels] = getR2Tokens(T)
 	#next, contact the server to calculate coreference resolution
-	flatSentence = ' '.join(outputSentence).replace(' .', '.')
+	flatSentence = tokensToText(outputSentence)
 	
 	sentenceHistory = []
 	def updateHistory(step):
 		st = ' '.join([w for w in outputSentence if w!=None])
 		if len(sentenceHistory)==0 or st != sentenceHistory[-1][0]:
 			sentenceHistory.append([st, step])
-	with CoreNLPClient(endpoint="http://localhost:" + str(coreNlpPort)) as client:
-		ann = client.annotate(flatSentence)
+	client = getCoreNLPClient("http://localhost:" + str(coreNlpPort))
+	chains = lookupPrecomputedChains(flatSentence)
+	ann = None
+	if chains == None:
+		ann = client.annotate(flatSentence, annotators=corefAnnotators)
 		# print("Passed:", flatSentence, '\n\toutputSentence:', outputSentence)
 		crc = ann.corefChain
 		# print(ann.__dir__())
-		chains = [parseCrc(str(chain)) for chain in crc]
-		# print(chains)
-		updateHistory('start')
+		chains = [parseCrc(chain) for chain in crc]
+	# print(chains)
+	updateHistory('start')
 	if len(chains)==0:
 		return [0, T_backup]
+	originalSentence = list(outputSentence)
+	oneForOne = True #set to False as soon as an edit adds or removes tokens, which means the sentence has to be re-parsed
 	
 	chainNames = []
 	for (chainIndex, chain) in enumerate(chains):
@@ -233,6 +425,7 @@ def R2(T, snlp=None):
 				outputSentence[link['beginIndex']] = chainName
 				for i in range(link['beginIndex']+1, link['endIndex']):
 					outputSentence[i] = None
+					oneForOne = False
 		else:# len(propers)==0:
 			chainName = 'p:DefaultName' + str(chainIndex)
 		updateHistory('removed propers')
@@ -248,6 +441,7 @@ def R2(T, snlp=None):
 			possessive = ['my', 'our', 'your', 'his', 'her', 'its', 'their', 'mine', 'ours', 'yours', 'hers', 'theirs']
 			if outputSentence[link['beginIndex']].lower() in possessive:
 				outputSentence[link['beginIndex']] = chainName + "'s"
+				oneForOne = False
 			else:
 				outputSentence[link['beginIndex']] = chainName
 			updateHistory('removed pronominals, ' + str(link))
@@ -266,30 +460,27 @@ def R2(T, snlp=None):
 				outputSentence[i] = None
 			#add sentence
 			outputSentence += [chainName, 'is'] + nominal + ['.']
+			oneForOne = False
 			updateHistory("removed nominal")
+	if outputSentence == originalSentence: #there were chains, but none of them led to an edit
+		return [0, T_backup]
 	
 	#replace all p:, n:, and a: tags
 	for i in range(len(outputLabels)):
 		if outputLabels[i]!=None and outputSentence[i]!=None:
 			outputSentence[i] = outputLabels[i] + 'xxjxx' + outputSentence[i]
+	#if every edit replaced one token with one token, reuse the parse we already have
+	if oneForOne and ann != None:
+		newWords = [w.replace('xxjxx', ':') for w in outputSentence]
+		toReturn = reuseParse(ann, originalSentence, newWords)
+		if toReturn != None:
+			updateHistory("about to return (reused parse)")
+			return [1, toReturn]
 	#turn it into a string, then get new constituency parse:
-	with CoreNLPClient(endpoint="http://localhost:" + str(coreNlpPort), annotators=['parse']) as client:
-		text = ' '.join([w for w in outputSentence if w!=None]).replace(':', 'xxjxx').replace(' .', '.')
-		# print("asking to parse:", text)
-		parse = client.annotate(text)
-	#converts the funky format stanfordCoreNlp uses to the S-expression tree format we need
-	def snlpToString(node): 
-		if len(node.child)==0:
-			return node.value.replace('xxjxx', ':')
-		toReturn = [node.value.replace('xxjxx', ':')]
-		for c in node.child:
-			toReturn.append(snlpToString(c))
-		return toReturn
-	trees = [snlpToString(s.parseTree) for s in parse.sentence]
-	#merge them all
-	toReturn = ['ROOT']
-	for t in trees:
-		toReturn = toReturn + t[1:]
+	text = ' '.join([w for w in outputSentence if w!=None]).replace(':', 'xxjxx').replace(' .', '.')
+	# print("asking to parse:", text)
+	parse = client.annotate(text, annotators=['parse'])
+	toReturn = mergeSentenceTrees([snlpToString(s.parseTree) for s in parse.sentence])
 	updateHistory("about to return")
 	# print("SENTENCE HISTORY:")
 	# for l in sentenceHistory:
@@ -306,21 +497,201 @@ def R2(T, snlp=None):
 	# 	return ' '.join([w for w in outputSentence if w!=None])
 
 
-nextIndex = 0
-"""Replace past tense verbs (VBD/VBN) with present tense, using pattern.en. (https://www.clips.uantwerpen.be/pages/pattern)
-Uses snlp's dependency parser to determine what the subject of each verb is.
-This is NOT a recursive rule; if calling with applyRule(), use recursive=False.
+"""Returns a stanfordnlp pipeline with only the processors R3 needs. It takes sentences that are already split into words
+(the leaves of the trees), so the indices of the dependency parse line up with the leaves, and any number of sentences
+can be parsed in one call (see prefetchDependencyParses). Other keyword arguments are passed on to stanfordnlp.Pipeline.
 """
-def R3(T, snlp):
-	#first, convert to a sentence and get the dependency parse
-	sentence = ' '.join(getWordSequence(T))
-	dparse = snlp(sentence)
-	#find out what the subjects of each verb are
+def loadR3Pipeline(**kwargs):
+	return stanfordnlp.Pipeline(processors='tokenize,pos,lemma,depparse', tokenize_pretokenized=True, **kwargs)
+
+dependencyCacheSize = 100000 #number of sentences whose verb subjects are kept in memory
+_subjectCache = OrderedDict() #tuple of words -> {index of a verb: its subject}, least recently used first
+
+#the subjects of each verb in a sentence of a stanfordnlp Document
+def _subjectsOf(dsentence):
 	subjectOf = dict() #key: index of a verb, value: the subject of this verb
-	for (v,t,o) in dparse.sentences[0].dependencies:
+	for (v,t,o) in dsentence.dependencies:
 		if t=='nsubj':
 			subjectOf[int(v.index)] = o.text
 			# print("The verb", v.text, "at position", v.index, "has subject", o.text)
+	return subjectOf
+
+def _cacheSubjects(words, subjectOf):
+	_subjectCache[words] = subjectOf
+	if len(_subjectCache) > dependencyCacheSize:
+		_subjectCache.popitem(last=False)
+
+#pipelines created with loadR3Pipeline() take lists of words. Other pipelines are given the sentence as text, as before.
+def _isPretokenized(snlp):
+	return getattr(snlp, 'config', dict()).get('tokenize_pretokenized', False)
+
+"""Returns {index of a verb: its subject} for the sentence with the given words, from the cache if it was parsed before."""
+def getVerbSubjects(words, snlp):
+	words = tuple(words)
+	if words in _subjectCache:
+		_subjectCache.move_to_end(words)
+		return _subjectCache[words]
+	if _isPretokenized(snlp):
+		dparse = snlp([list(words)])
+	else:
+		dparse = snlp(' '.join(words))
+	subjectOf = _subjectsOf(dparse.sentences[0])
+	_cacheSubjects(words, subjectOf)
+	return subjectOf
+
+"""Dependency parses the sentences of all trees in Ts that aren't in the cache yet, in a single batched call to snlp, so
+that R3 only has to look them up. snlp should be created with loadR3Pipeline(); for other pipelines this does nothing.
+"""
+def prefetchDependencyParses(Ts, snlp):
+	if not _isPretokenized(snlp):
+		return
+	toParse = []
+	for T in Ts:
+		if r3Mode=='tree' and treeVerbSubjects(T) != None:
+			continue #R3 won't need to parse this one
+		words = tuple(getWordSequence(T))
+		if len(words)>0 and words not in _subjectCache:
+			toParse.append(words)
+	toParse = list(dict.fromkeys(toParse))
+	if len(toParse)==0:
+		return
+	dparse = snlp([list(words) for words in toParse])
+	if len(dparse.sentences) != len(toParse):
+		return #shouldn't happen with pretokenized input, but if it does, let R3 parse them one at a time
+	for (words, dsentence) in zip(toParse, dparse.sentences):
+		_cacheSubjects(words, _subjectsOf(dsentence))
+
+r3Mode = 'neural' #'tree': find the subjects of verbs with treeVerbSubjects(), and only dependency parse the sentence if that is ambiguous
+r3Stats = {'tree':0, 'fallback':0} #in 'tree' mode: number of sentences R3 handled from the tree, and number it had to dependency parse
+
+_nounTags = ['NN', 'NNS', 'NNP', 'NNPS', 'PRP', 'CD']
+_beForms = ['is', 'are', 'was', 'were', 'am', 'be', 'been', 'being']
+
+class _AmbiguousTree(Exception):
+	pass
+
+"""Finds the subject of each verb from constituency tree T with head-finding rules, in the same form R3 gets from the
+dependency parse: {index of a word: the word that is its subject}. As in the dependency parse, the subject belongs to the
+main verb of a chain of auxiliaries, and to the predicate (noun, adjective or object of a preposition) of a copula.
+Returns None if T has a structure these rules don't handle confidently (clauses without an NP subject, coordinated verb
+phrases, expletive 'there', relative clauses, or a VBD/VBZ verb that isn't accounted for), in which case R3 has to fall
+back on the dependency parse.
+"""
+def treeVerbSubjects(T):
+	index = dict() #id of a preterminal -> its position, counted the same way as in R3
+	def number(t):
+		if isinstance(t, str) or len(t) < 2:
+			return
+		if isinstance(t[1], str):
+			index[id(t)] = len(index) + 1
+		else:
+			for c in t[1:]:
+				number(c)
+	number(T)
+	def isPreterminal(t):
+		return isinstance(t, list) and len(t) >= 2 and isinstance(t[1], str)
+	def phrases(t):
+		return [c for c in t[1:] if isinstance(c, list) and len(c) >= 2]
+	def plainWord(t):
+		return t[1][t[1].index(':')+1:] if ':' in t[1] else t[1]
+	explained = set() #verbs that have no subject in the dependency parse (auxiliaries and copulas)
+
+	#the preterminal that heads noun phrase t
+	def nounHead(t):
+		if isPreterminal(t):
+			if t[0] in _nounTags:
+				return t
+			raise _AmbiguousTree()
+		children = phrases(t)
+		if any(c[0]=='CC' for c in children) or (len(children) > 0 and children[0][0]=='NP'):
+			#coordination, or a noun phrase modified by a PP, SBAR, etc.: the head is that of the first NP
+			for c in children:
+				if c[0]=='NP':
+					return nounHead(c)
+			raise _AmbiguousTree()
+		for c in reversed(children):
+			if isPreterminal(c) and c[0] in _nounTags:
+				return c
+		raise _AmbiguousTree()
+
+	#the preterminal that the subject of verb phrase t depends on
+	def predicateHead(t):
+		children = phrases(t)
+		vps = [c for c in children if c[0]=='VP']
+		if len(vps) > 1 or any(c[0]=='CC' for c in children):
+			raise _AmbiguousTree()
+		verbs = [c for c in children if isPreterminal(c) and (c[0].startswith('VB') or c[0]=='MD')]
+		if len(vps)==1: #the verbs before it are auxiliaries
+			explained.update(id(v) for v in verbs)
+			return predicateHead(vps[0])
+		if len(verbs)==0:
+			raise _AmbiguousTree()
+		verb = verbs[0]
+		if plainWord(verb).lower() in _beForms:
+			complements = [c for c in children[children.index(verb)+1:] if c[0] in ['NP', 'ADJP', 'PP']]
+			if len(complements) > 0:
+				explained.add(id(verb))
+				complement = complements[0]
+				if complement[0]=='NP':
+					return nounHead(complement)
+				if complement[0]=='PP':
+					objects = [c for c in phrases(complement) if c[0]=='NP']
+					if len(objects)==0:
+						raise _AmbiguousTree()
+					return nounHead(objects[0])
+				adjectives = [c for c in phrases(complement) if isPreterminal(c) and c[0].startswith('JJ')]
+				if isPreterminal(complement) or len(adjectives)==0:
+					raise _AmbiguousTree()
+				return adjectives[-1]
+		return verb
+
+	subjectOf = dict()
+	def findClauses(t):
+		if isPreterminal(t) or not isinstance(t, list):
+			return
+		if t[0] in ['SINV', 'SQ']:
+			raise _AmbiguousTree()
+		if t[0]=='S':
+			children = phrases(t)
+			vps = [i for (i,c) in enumerate(children) if c[0]=='VP']
+			if len(vps) > 1:
+				raise _AmbiguousTree()
+			if len(vps)==1:
+				subjects = [c for c in children[:vps[0]] if c[0]=='NP']
+				if len(subjects) > 0:
+					subject = nounHead(subjects[-1])
+					subjectOf[index[id(predicateHead(children[vps[0]]))]] = subject[1]
+		for c in t[1:]:
+			findClauses(c)
+	def checkVerbs(t):
+		if isPreterminal(t):
+			if t[0] in ['VBD', 'VBZ'] and index[id(t)] not in subjectOf and id(t) not in explained:
+				raise _AmbiguousTree()
+		elif isinstance(t, list):
+			for c in t[1:]:
+				checkVerbs(c)
+	try:
+		findClauses(T)
+		checkVerbs(T)
+	except _AmbiguousTree:
+		return None
+	return subjectOf
+
+nextIndex = 0
+"""Replace past tense verbs (VBD/VBN) with present tense, using pattern.en. (https://www.clips.uantwerpen.be/pages/pattern)
+Uses snlp's dependency parser to determine what the subject of each verb is. Parses are cached by sentence, and can be
+computed in batches beforehand with prefetchDependencyParses(). If r3Mode is 'tree', the subjects are found from T itself
+when possible (see treeVerbSubjects), which is much faster but occasionally differs from the dependency parse.
+This is NOT a recursive rule; if calling with applyRule(), use recursive=False.
+"""
+def R3(T, snlp):
+	#first, find out what the subjects of each verb are
+	subjectOf = None
+	if r3Mode=='tree':
+		subjectOf = treeVerbSubjects(T)
+		r3Stats['tree' if subjectOf != None else 'fallback'] += 1
+	if subjectOf == None:
+		subjectOf = getVerbSubjects(getWordSequence(T), snlp)
 	#go through the tree and label all of the indices of the words
 	global nextIndex
 	nextIndex = 0
@@ -449,6 +820,17 @@ def R8(T, snlp=None):
 	return [0,T]
 
 
+#the nodes each recursive rule can fire on, used by applyRules() to skip the rest: a list of labels, 'preterminal' (a node whose
+#first child is a word) or 'phrase' (a node with at least one child, the first of which isn't a word). Rules not listed here are tried on every node.
+recursiveRuleTargets = {
+	R1: ['NP'],
+	R4: 'preterminal',
+	R5: 'phrase',
+	R6: ['VP'],
+	R7: ['ADVP'],
+	R8: ['VP'],
+}
+
 """Wasn't in original FLAIRS submission. Takes certain forms of descriptive utterances and converts them to proper sentences. 
 
 If it is a non-sentence with an "-ing" verb, then convert it to "is -ing". Note that running this before rule R8 is ideal.
@@ -552,16 +934,38 @@ def replaceIn(T,hypernyms):
 		return toReturn
 
 def getWordsByPOS(T, posTags):
+	if isinstance(T, ConstituencyTree):
+		return T.wordsByPOS(posTags)
 	if isinstance(T,str):
 		return []
 	if T[0] in posTags: 
 		return [T]
 	else:
 		toReturn = []
-		for c in T:
+		for c in T[1:]:
 			toReturn += getWordsByPOS(c, posTags)
 		return toReturn
 
+"""Given a set of words, returns [hypernyms, nonHypernyms], where hypernyms[w1] is the set of words w2 that are hypernyms of w1,
+and nonHypernyms[w1] is the set of words w2 where neither is a hypernym of the other. Both are derived from a single
+hypernymMatrix() over the words (and its transpose), rather than querying WordNet for each ordered pair.
+"""
+def hypernymRelations(words, pos):
+	words = list(words)
+	M = hypernymMatrix(words, pos)
+	hypernyms = {w:set() for w in words}
+	nonHypernyms = {w:set() for w in words}
+	for i in range(len(words)):
+		for j in range(len(words)):
+			if i==j:
+				continue
+			if M[i][j]:
+				hypernyms[words[i]].add(words[j])
+			elif not M[j][i]:
+				nonHypernyms[words[i]].add(words[j])
+				nonHypernyms[words[j]].add(words[i])
+	return [hypernyms, nonHypernyms]
+
 """Input: the premise and hypothesis constituency trees, in the form of nested lists.
 Returns: a dictionary which has singular nouns as keys, and a set of its hypernyms as values, only using nouns that appear in Tp or Th.
 """
@@ -588,19 +992,7 @@ def S1(Tp, Th):
 			n = singularize(n)
 		allNouns.add(n.lower())
 	#find hypernym relationships between all nouns here
-	hypernyms = {n:set() for n in allNouns}
-	nonHypernyms = {n:set() for n in allNouns}
-	for n1 in allNouns:
-		for n2 in allNouns:
-			if n1==n2:
-				continue
-			if findHypernym_onedir(n1,n2,'n'):
-				hypernyms[n1].add(n2)
-			else:
-				if not findHypernym_onedir(n2, n1, 'n'):
-					nonHypernyms[n1].add(n2)
-					nonHypernyms[n2].add(n1)
-	return [hypernyms, nonHypernyms]
+	return hypernymRelations(allNouns, 'n')
 
 """Same as S1, except it does it with verbs instead of nouns.
 """
@@ -622,19 +1014,7 @@ def S2(Tp, Th):
 		v = conjugate(v, 'inf').lower()
 		allVerbs.add(v)
 	#find hypernym relationships between all verbs
-	hypernyms = {v:set() for v in allVerbs}
-	nonHypernyms = {v:set() for v in allVerbs}
-	for v1 in allVerbs:
-		for v2 in allVerbs:
-			if v1==v2:
-				continue
-			if findHypernym_onedir(v1,v2,'v'):
-				hypernyms[v1].add(v2)
-			else:
-				if not findHypernym_onedir(v2, v1, 'v'):
-					nonHypernyms[v1].add(v2)
-					nonHypernyms[v2].add(v1)
-	return [hypernyms, nonHypernyms]
+	return hypernymRelations(allVerbs, 'v')
 
 nextIndex = 0
 """Determine what the subject of the first sentence of Tp and Th are.
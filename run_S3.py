@@ -5,6 +5,10 @@ See https://github.com/AMHRLab/NLIwithACE/edit/master/README.md for installation
 
 If you divide into 10 parts, you can easily run them in parallel using the following bash script:
 for i in {0..9}; do   python run_S3.py $i & done
+
+Alternatively, run `python run_S3.py parallel [numWorkers]`. This starts numWorkers worker processes which each load their
+models once, and hand out the problems in small chunks to whichever worker is free, so a slow part of the dataset doesn't
+hold up the others. The outputs and counters of all workers are merged at the end (into files labelled "all").
 """
 
 import stanfordnlp
@@ -12,74 +16,646 @@ from translateFOF import treeToSexp, translateFOF_formula, removeDuplicateQuanti
 from FOL_resolution import printSExpNice, propStructToSExp, findContradiction, parseExpression
 from ape import *#sentenceToTPTP, sentenceEntailment
 from rewriteRules import *
+from snli_reader import iterSNLI, countPairs
+from wordnet_utils import persistHypernymCache, saveHypernymCache
+from stage_cache import StageCache
+from result_sink import ResultSink
+from progress_journal import ProgressJournal
+from metrics import Metrics, appendSnapshot
+import ape
+import rewriteRules
+import morphology
+import wordnet_utils
+import inspect
 import os
 import sys
 import re
 import time
+import glob
+import copy
+import json
+import multiprocessing
 
-"""Point this to one of the text files that are part of the SNLI dataset. 
+"""Point this to one of the text files that are part of the SNLI dataset (the .jsonl files work too). 
 """
 # SNLI_LOCATION = "snli/snli/1.0_dev.txt"
 # SNLI_LOCATION = "snli/snli_1.0_dev.txt"
 SNLI_LOCATION = "snli/snli_1.0_train.txt"
 numDivisions = 10 #number of parts to divide the dataset into
 experimentLabel = 'Output' #It will write output to a directory called 'attempts'.
+numAPEWorkers = 1 #number of resident APE processes to keep running (see ape.startAPEWorkers). Set to 0 to start ape.exe once per sentence instead.
+numWorkers = 10 #number of worker processes used by `python run_S3.py parallel`
+chunkSize = 20 #number of problems (at least, see chunksByPremise) a worker takes at a time in parallel mode, and that are dependency parsed together for R3
+tptpCacheLocation = "attempts/tptp_cache.sqlite" #on-disk cache of ACE->TPTP translations, shared by all processes. Set to None to disable.
+hypernymCacheLocation = "attempts/hypernym_cache.pickle" #WordNet hypernym closures computed in previous runs. Set to None to disable.
+stageCacheLocation = "attempts/stage_cache.sqlite" #what each stage computed for each problem in previous runs (see stage_cache.StageCache). Set to None to disable.
+#the stages whose outputs are cached, in order, with a version tag for each. After changing what a stage computes, bump its
+#version: that stage and the ones after it are then recomputed, while the earlier ones are still read from the cache. The
+#settings that change what they compute (e.g. rewriteRules.r3Mode, ape.proverMode, the WordNet and morphology tables) are
+#added to the tags automatically, see stageSettings().
+#stage0 = answer on the unmodified sentences, rules = trees after the syntactic rules, stage1 = formulas and answer on them,
+#stage2 = S3, S1 and S2 and the answer with their axioms, stage3 = the answer with the negative axioms too
+stageVersions = [['stage0', '1'], ['rules', '1'], ['stage1', '1'], ['stage2', '2'], ['stage3', '1']]
+stageCache = None #set by setupProcess()
+jsonlOutput = False #also write everything a process outputs to a single JSONL file (see result_sink.ResultSink)
+metricsInterval = 30 #seconds between the snapshots of the metrics (see newCounters()) a process writes to its _metrics.jsonl file, on top of the ones at each status report
+
+#cleans up a constituency parse from SNLI for punctuation, before it is given to parseConstituency()
+def cleanConstituency(s):
+	for punct in ['(. ,)', '(. .)', '(. !)']:
+		s = s.replace(punct, '')
+	return s.replace('.', '')
+
+#returns the name of one of the output files written by process processId.
+#kind is one of 'correct', 'incorrect', 'parseFails', 'errors', 'parsedSentences', 'jsonl' (see jsonlOutput), 'progress'
+#(the journal of the problems it has finished, see progress_journal.ProgressJournal) or 'metrics' (see writeMetrics()).
+def outputFile(processId, kind):
+	if kind=='metrics':
+		return "attempts/" + experimentLabel + '_' + str(processId) + "_metrics.jsonl"
+	if kind=='progress':
+		return "attempts/" + experimentLabel + '_' + str(processId) + ".journal"
+	if kind=='parsedSentences':
+		return "attempts/" + experimentLabel + '_parsedSentences_' + str(processId) + ".tsv"
+	if kind=='jsonl':
+		return "attempts/" + experimentLabel + '_' + str(processId) + ".jsonl"
+	return "attempts/" + experimentLabel + '_' + str(processId) + '_' + kind + ".txt"
+
+#the columns of the lines in each kind of output file
+outputColumns = {'correct':['gold_label', 'premiseACE', 'hypothesisACE', 'premise', 'hypothesis'],
+	'incorrect':['gold_label', 'guess', 'premiseACE', 'hypothesisACE', 'premise', 'hypothesis'],
+	'parseFails':['gold_label', 'premiseACE', 'hypothesisACE', 'premise', 'hypothesis'],
+	'parsedSentences':['sentence1', 'sentence2', 'gold_label', 'premiseFormula', 'hypothesisFormula'],
+	'errors':['details']}
+
+_resultSinks = dict() #processId -> ResultSink
+
+#returns the ResultSink that writes the output files of process processId
+def resultSink(processId):
+	if processId not in _resultSinks:
+		jsonlPath = outputFile(processId, 'jsonl') if jsonlOutput else None
+		_resultSinks[processId] = ResultSink(lambda kind: outputFile(processId, kind), outputColumns, jsonlPath)
+	return _resultSinks[processId]
+
+def closeResultSinks():
+	for sink in _resultSinks.values():
+		sink.close()
+	_resultSinks.clear()
+
+#the kinds of output files a process writes results to
+def outputKinds():
+	return ['correct', 'incorrect', 'parseFails', 'errors', 'parsedSentences'] + (['jsonl'] if jsonlOutput else [])
+
+#returns {file: size} of the output files of process processId (0 for the ones that don't exist yet), which is stored in its
+#progress journal so that what was written after the last save can be removed again (see truncateOutputs())
+def outputSizes(processId):
+	toReturn = dict()
+	for kind in outputKinds():
+		f = outputFile(processId, kind)
+		toReturn[f] = os.path.getsize(f) if os.path.exists(f) else 0
+	return toReturn
+
+#cuts the files in sizes ({file: size}, from outputSizes()) back to those sizes, removing the lines written for problems that
+#weren't recorded as done in the progress journal, so they aren't output twice when those problems are solved again
+def truncateOutputs(sizes):
+	for [f, size] in sizes.items():
+		if os.path.exists(f) and os.path.getsize(f) > size:
+			os.truncate(f, size)
 
 """Applies syntactic transformation rules to constituency tree T.
 Returns a new constituency parse tree.
-snlp = an object created using stanfordnlp.Pipeline()
-varsToStore = a list of strings, each of which is the name of a variable you want to store in the log.
+snlp = an object created using rewriteRules.loadR3Pipeline() (or stanfordnlp.Pipeline())
+details = a dictionary of values to print if one of the rules fails (e.g. the problem index, see getDetails()).
 """
-def applySyntacticRules(T, snlp, varsToStore=[]):
+def applySyntacticRules(T, snlp, details=dict()):
+	return applyR3(applyRulesBeforeR3(T, snlp, details), snlp, details)
+
+numRuleFailures = 0 #number of times a syntactic rule raised an exception, and was skipped
+
+#logs that rule (its name) raised exception e on tree T, and counts it in numRuleFailures
+def reportRuleFailure(rule, T, details, e):
+	global numRuleFailures
+	numRuleFailures += 1
+	print("\n\nMessed up on rule", rule, ", skipping...")
+	print("I was trying to apply the rule to this tree:", T)
+	print("Full details:", str(details))
+	print("Exception", e)
+	traceback.print_exc(file=sys.stdout)
+
+#the number of failures so far that may not happen again on a rerun: APE worker timeouts and skipped rules (e.g. R2 when
+#the CoreNLP server is down). What was computed while one of these happened isn't stored in the stage cache.
+def transientFailures():
+	return transientFailureCount() + numRuleFailures
+
+#the first part of applySyntacticRules(): every rule except R3
+def applyRulesBeforeR3(T, snlp, details=dict()):
+	T = applyRulesBeforeR2(T, snlp, details)
+	#Apply nonrecursive rules
+	rules = [R2]  
+	for rule in rules:
+		try:
+			[n, T] = applyRule(T, rule, False, snlp=snlp)
+		except Exception as e:
+			reportRuleFailure(str(rule), T, details, e)
+	return T
+
+#the rules applyRulesBeforeR3() applies before R2: R9, then R1 and R4-R8. So this gives the trees whose text R2 annotates.
+def applyRulesBeforeR2(T, snlp, details=dict()):
 	#Apply rule R9, because it completes sentence fragments and must be done before R8
 	try:
 		[n, T] = applyRule(T, R9, False, snlp=snlp)
 	except Exception as e:
-		print("\n\nMessed up on rule R9, skipping...")
-		print("I was trying to apply the rule to this tree:", T)
-		print("Full details:", str({v:eval(v) for v in varsToStore}))
-		print("Exception", e)
-		traceback.print_exc(file=sys.stdout)
+		reportRuleFailure('R9', T, details, e)
 		# input("Press enter...")	
 	rules = [R1, R4, R5, R6, R7, R8]  
-	#Apply recursive rules
-	for rule in rules:
-		try:
-			[n, T] = applyRule(T, rule, snlp=snlp)
-		except Exception as e:
-			print("\n\nMessed up on rule", str(rule), ", skipping...")
-			print("I was trying to apply the rule to this tree:", T)
-			print("Full details:", str({v:eval(v) for v in varsToStore}))
-			print("Exception", e)
-			traceback.print_exc(file=sys.stdout)
-	#Apply nonrecursive rules
-	rules = [R2, R3]  
-	for rule in rules:
-		try:
-			[n, T] = applyRule(T, rule, False, snlp=snlp)
-		except Exception as e:
-			print("\n\nMessed up on rule", str(rule), ", skipping...")
-			print("I was trying to apply the rule to this tree:", T)
-			print("Full details:", str({v:eval(v) for v in varsToStore}))
-			print("Exception", e)
-			traceback.print_exc(file=sys.stdout)
+	#Apply recursive rules, all in one pass over the tree
+	backup = copyTree(T)
+	try:
+		[counts, T] = applyRules(T, rules, snlp=snlp)
+	except Exception:
+		#one of them failed, so apply them one at a time to the original tree instead, skipping the one that fails
+		T = backup
+		for rule in rules:
+			try:
+				[n, T] = applyRule(T, rule, snlp=snlp)
+			except Exception as e:
+				reportRuleFailure(str(rule), T, details, e)
 	return T
 
-if __name__=="__main__":
-	with open(SNLI_LOCATION, 'r') as F:
-		allLines = [l.strip().split('\t') for l in F.readlines()[1:]]
-	processId = int(sys.argv[1])
-	numPerProcess = int(len(allLines)/numDivisions)
-	startAt = numPerProcess*processId
-	allLines = [l for l in allLines[startAt:startAt+numPerProcess]]
+#the last part of applySyntacticRules(): R3, which is last because it needs a dependency parse of the rewritten sentence
+def applyR3(T, snlp, details=dict()):
+	try:
+		[n, T] = applyRule(T, R3, False, snlp=snlp)
+	except Exception as e:
+		reportRuleFailure(str(R3), T, details, e)
+	return T
 
+#loads stanfordnlp, starts the APE workers and opens the TPTP cache. Returns [snlp, cache].
+def setupProcess():
 	with open("garbage.txt",'w') as G: #silence the output that stanfordnlp spits out
 		print("Loading stanfordnlp...")
 		oldOut = sys.stdout
 		sys.stdout = G
-		snlp = stanfordnlp.Pipeline()
+		snlp = loadR3Pipeline()
 		sys.stdout = oldOut
 		print("Done.")
+	if numAPEWorkers > 0:
+		print("Starting", numAPEWorkers, "APE worker(s)...")
+		startAPEWorkers(numAPEWorkers)
+	cache = None
+	if tptpCacheLocation != None:
+		cache = enableTPTPCache(tptpCacheLocation)
+	if hypernymCacheLocation != None:
+		persistHypernymCache(hypernymCacheLocation)
+	global stageCache
+	if stageCacheLocation != None:
+		settings = stageSettings()
+		versions = [[stage, str(version) + ' ' + settings[stage]] for [stage, version] in stageVersions]
+		stageCache = StageCache(stageCacheLocation, versions, lexiconVersion())
+	return [snlp, cache]
+
+#identifies the contents of the file at path by its size and modification time, for stageSettings()
+def fileVersion(path):
+	if path == None or not os.path.exists(path):
+		return 'none'
+	info = os.stat(path)
+	return str(info.st_size) + '@' + str(int(info.st_mtime))
+
+#the version of the installed nltk (whose WordNet S1 and S2 use when there's no hypernym index), or '' if it can't be found
+def nltkVersion():
+	try:
+		from importlib.metadata import version
+		return version('nltk')
+	except Exception:
+		return ''
+
+#returns {stage: the settings (other than the code) what the stage computes depends on}, which are added to the stages' version
+#tags in the stage cache, so that changing one of them also recomputes the stage and the ones after it
+def stageSettings():
+	maxNumClauses = inspect.signature(sentenceEntailment).parameters['maxNumClauses'].default
+	return {'stage0':'proverMode=' + ape.proverMode + ' maxNumClauses=' + str(maxNumClauses),
+		'rules':'r3Mode=' + rewriteRules.r3Mode + ' chains=' + fileVersion(rewriteRules.precomputedChainsLocation) +
+			' morphology=' + fileVersion(morphology.morphologyTableLocation),
+		'stage1':'',
+		'stage2':'hypernyms=' + fileVersion(wordnet_utils.hypernymIndexLocation) + ' nltk=' + nltkVersion(),
+		'stage3':''}
+
+#returns [found, value]: what stage computed for pair in a previous run, if the stage cache has it
+def lookupStage(stage, pair):
+	if stageCache == None:
+		return [False, None]
+	return stageCache.get(stage, pair.sentence1_parse, pair.sentence2_parse)
+
+def storeStage(stage, pair, value):
+	if stageCache != None:
+		stageCache.put(stage, pair.sentence1_parse, pair.sentence2_parse, value)
+
+#returns what stage computed for pair in a previous run if the stage cache has it, otherwise compute() (which is then stored,
+#unless there was a transient failure while computing it). If counters are given, the time this took is added to the stage's
+#histogram in them.
+def cachedStage(stage, pair, compute, counters=None):
+	startTime = time.time()
+	[found, value] = lookupStage(stage, pair)
+	if not found:
+		failuresBefore = transientFailures()
+		value = compute()
+		if transientFailures() == failuresBefore:
+			storeStage(stage, pair, value)
+	if counters != None:
+		counters[stage + 'Seconds'].observe(time.time() - startTime)
+	return value
+
+#translates the unmodified sentences of a list of SNLIPairs up front, so the first stage only has to look them up in the TPTP cache
+def translateStage0(pairs):
+	toTranslate = []
+	for pair in pairs:
+		if pair.gold_label=='-':
+			continue
+		if stageCache != None and stageCache.contains('stage0', pair.sentence1_parse, pair.sentence2_parse):
+			continue #stage 0 won't need the translations
+		for s in [pair.sentence1_parse, pair.sentence2_parse]:
+			try:
+				toTranslate.append(treeToACEInput(parseConstituency(cleanConstituency(s))))
+			except Exception:
+				pass #this problem will report the error when it gets to it
+	sentenceToTPTP_many(toTranslate, numAPEWorkers)
+
+"""Returns the metrics (see metrics.Metrics) of the problems a process solves, which are written to its _metrics.jsonl file.
+The <stage>Seconds histograms (e.g. stage0Seconds, rulesSeconds) have the time each stage of stageVersions took (including
+looking it up in the stage cache) for each problem that got to it.
+"""
+def newCounters():
+	counters = Metrics()
+	counters.counter('attempted') #number of sentences tried to parse
+	counters.counter('coverage') #number of sentences parsed successfully
+	counters.labeledCounter('score_A2', ['correct', 'wrong']) #guesses made at stage 1 or 2 (out of successful parses)
+	counters.labeledCounter('score_A3', ['correct', 'wrong']) #guesses made at stage 3 (out of successful parses)
+	counters.labeledCounter('stoppedAtStage', [0, 1, 2, 3, 4])
+	counters.labeledCounter('ruleCounts', ['S1', 'S2', 'S3'])
+	counters.labeledCounter('r3Stats', ['tree', 'fallback']) #how R3 found the subjects of verbs (see rewriteRules.r3Mode)
+	counters.counter('solved') #number of problems solved (the ones with a gold label)
+	counters.counter('solveSeconds') #time spent solving them
+	for [stage, version] in stageVersions:
+		counters.histogram(stage + 'Seconds')
+	return counters
+
+#the values that are printed, and stored in the _errors.txt files, when something goes wrong with problem i
+def getDetails(processId, i, startAt):
+	return {'experimentLabel':experimentLabel, 'processId':processId, 'i':i, 'startAt':startAt}
+
+#appends a snapshot of counters (created by newCounters()) to the _metrics.jsonl file of process processId.
+#numDone = number of problems done out of total, rate = problems per second.
+def writeMetrics(processId, counters, numDone, total, rate):
+	appendSnapshot(outputFile(processId, 'metrics'), {'time':time.time(), 'experimentLabel':experimentLabel, 'processId':processId,
+		'done':numDone, 'total':total, 'problemsPerSecond':rate, 'metrics':counters.toJSON()})
+
+#prints the metrics of process processId, which is at problem i of total, and writes them to its _metrics.jsonl file
+def reportStatus(processId, i, total, counters, rate, cache):
+	print("\n\nPROCESS", processId, "ON ITERATION", i, "of", total, ":")
+	if counters['solved'].value>0:
+		print("\tAverage time per problem:", counters['solveSeconds'].value/counters['solved'].value)
+	print("\tProblems per second:", rate)
+	for [v, value] in counters.summary().items():
+		print('\t', v, ':', value)
+	if cache != None:
+		print('\t', 'TPTP cache :', cache.stats())
+	if stageCache != None:
+		print('\t', 'stage cache :', stageCache.stats())
+	writeMetrics(processId, counters, i, total, rate)
+
+scoreCounters = {1:'score_A2', 2:'score_A2', 3:'score_A3'} #the stage a guess was made at -> the score it counts towards
+
+#Ap, Ah = the ACE sentences (treeToACEInput()) of the premise and hypothesis, stage = the stage the guess was made at
+def assessGuess(guess, correct, Ap, Ah, p, h, processId, counters, stage):
+	# print("Correct:", correct, "My guess:", guess)
+	# input("Press enter...")
+	if correct==guess:
+		resultSink(processId).write('correct', [correct, Ap, Ah, p, h], strip=True)
+	else:
+		resultSink(processId).write('incorrect', [correct, guess, Ap, Ah, p, h], strip=True)
+	if stage in scoreCounters:
+		counters[scoreCounters[stage]].add('correct' if correct==guess else 'wrong')
+
+"""The first stage of the tiered algorithm: tries to solve the problem without applying any rules. Returns None if it was solved,
+otherwise [result, Tp, Th], where result is what sentenceEntailment() returned and Tp, Th are the unmodified trees.
+"""
+def solveStage0(pair, processId, counters):
+	#######FIRST, Try it without applying any rules
+	correct = pair.gold_label
+	p = pair.sentence1_parse #constituency parse of premise
+	h = pair.sentence2_parse #constituency parse of hypothesis
+	p_raw = pair.sentence1 #raw text of premise
+	h_raw = pair.sentence2 #raw text of hypothesis
+
+	#clean them up for punctuation and shit
+	p = cleanConstituency(p)
+	h = cleanConstituency(h)
+
+	guess_values = ['neutral', 'entailment', 'contradiction']
+
+	# print("p is:", p)
+	# print("p_raw is:", p_raw)
+	# print("h is:", h)
+	# print("h_raw is:", h_raw)
+	# print("correct is:", correct)
+
+	#the rules start from new lists (see applyRule), so the trees themselves are only read
+	Tp = ConstituencyTree.fromList(parseConstituency(p))
+	Th = ConstituencyTree.fromList(parseConstituency(h))
+
+	# print("ORIGINAL:")
+	# print('\tP:'+' '.join(treeToACEInput(Tp)))
+	# print('\tH:'+' '.join(treeToACEInput(Th)))
+	counters['attempted'].inc(2)
+	#let's see if, before applying any rules whatsoever, it can parse and make a guess
+	Ap = treeToACEInput(Tp)
+	Ah = treeToACEInput(Th)
+	result = cachedStage('stage0', pair, lambda: sentenceEntailment(Ap, Ah), counters)
+	if result > 0: #if it guessed 'entailment' or 'contradiction'
+		counters['stoppedAtStage'].add(0)
+		counters['coverage'].inc(2)
+		assessGuess(guess_values[result], correct, Ap, Ah, p, h, processId, counters, 0)
+		return None
+	return [result, Tp, Th]
+
+"""The rest of the tiered algorithm, once the syntactic rules have been applied to the trees Tp and Th.
+result = the result of stage 0 (returned by solveStage0).
+premise = a dict shared by the problems with the same premise (and rewritten premise tree Tp), in which the premise's formula
+is kept, so it is only computed once. None to not share it.
+"""
+def solveRewritten(pair, result, Tp, Th, processId, counters, premise=None):
+	correct = pair.gold_label
+	p = cleanConstituency(pair.sentence1_parse)
+	h = cleanConstituency(pair.sentence2_parse)
+	p_raw = pair.sentence1
+	h_raw = pair.sentence2
+	guess_values = ['neutral', 'entailment', 'contradiction']
+	#the trees are only read from here on, and their words are needed several times (ACE input, output files, S1, S2).
+	#solveChunk() passes them in as ConstituencyTrees already, the premise's shared by its problems.
+	Tp = ConstituencyTree.fromList(Tp)
+	Th = ConstituencyTree.fromList(Th)
+	Ap = treeToACEInput(Tp) #the ACE sentences, which go to APE and to the output files
+	Ah = treeToACEInput(Th)
+
+	#get the parsed formulas. 
+	def parseACE(A): #A = an ACE sentence
+		tptp = sentenceToTPTP(A)
+		if tptp==None:
+			return None
+		return tptpsToSexp(tptp, returnList=True)
+
+	#returns [fp, fh, the reasoner's answer on them (None if one of them didn't parse)]
+	def stage1():
+		#the formulas are modified further on (e.g. by S3), so each problem gets its own copy of the premise's
+		if premise != None and 'fp' in premise:
+			fp = copy.deepcopy(premise['fp'])
+		else:
+			fp = compressFormulaTree(parseACE(Ap))
+			if premise != None and fp != None: #a failed parse is tried again (it may have been a timeout)
+				premise['fp'] = copy.deepcopy(fp)
+		fh = compressFormulaTree(parseACE(Ah))
+		if None in [fp,fh]:
+			return [fp, fh, None]
+		return [fp, fh, sentenceEntailment(fp, fh, passingFormulas=True)]#sentenceEntailment(treeToACEInput(Tp), treeToACEInput(Th))
+
+	[fp, fh, stage1Result] = cachedStage('stage1', pair, stage1, counters)
+
+	# print("\nEntailment between:\n\t", Tp, "\n\t", Th)
+
+	#TODO: record fp and fh, regardless of whether they parsed
+	fp_str = "None" if (fp==None) else propStructToSExp(fp)
+	fh_str = "None" if (fh==None) else propStructToSExp(fh)
+	resultSink(processId).write('parsedSentences', [p_raw, h_raw, correct, fp_str, fh_str])
+
+	#use normal entailment. If it guesses ent. or con., then save to file and go to next pair
+	if None in [fp,fh]: #at least one sentence failed to parse still
+		counters['stoppedAtStage'].add(1)
+		if result==-1: #at least one sentence parsed successfully
+			counters['coverage'].inc()
+		resultSink(processId).write('parseFails', [correct, Ap, Ah, p, h], strip=True)
+		return #call it a loss, don't count it
+	#if we're here, then both sentences now parse!
+	counters['coverage'].inc(2)
+	result = stage1Result
+	if result > 0: #did the reasoner make a guess of non-neutral?
+		counters['stoppedAtStage'].add(1)
+		assessGuess(guess_values[result], correct, Ap, Ah, p, h, processId, counters, 1)
+		return
+
+	##########FINALLY, TRY IT WITH THE SEMANTIC RULES
+
+	#returns the formulas after S3, what S1 and S2 found, the axioms they add and the reasoner's answer with them
+	def stage2(fp, fh):
+		#####S3#########
+		Tp_unmodified = R9(parseConstituency(p))[1] #apply R9 to fix sentence fragments, but nothing else
+		Th_unmodified = R9(parseConstituency(h))[1]
+		# print("Original sentences:", '\n\t', treeToACEInput(Tp_unmodified), '\n\t', treeToACEInput(Th_unmodified))
+		# print("Sentences after transforms:", '\n\t', treeToACEInput(Tp), '\n\t', treeToACEInput(Th))
+		# print("Original formulas:", '\n\t', fp, '\n\t', fh)
+		[fp, fh] = S3(Tp_unmodified, Th_unmodified, fp, fh)
+		# print("S3 formulas:", '\n\t', fp, '\n\t', fh)
+		# input("Press enter...")
+		fp = treeToSexp(fp)
+		fh = treeToSexp(fh)
+
+		# print("About to start S1")
+		#####S1#########
+		[hypernyms_n, nonHypernyms_n] = S1(Tp, Th)
+		extraFormulas = []
+		for w1 in hypernyms_n:
+			for w2 in hypernyms_n[w1]:
+				if w1==w2:
+					continue
+				extraFormulas.append('(FORALL x (IMPLIES (%s x) (%s x)))' % (w1, w2))
+		#####S2#########
+		[hypernyms_v, nonHypernyms_v] = S2(Tp, Th)
+		for w1 in hypernyms_v:
+			for w2 in hypernyms_v[w1]:
+				if w1==w2:
+					continue
+				#TODO: A smarter version of which would know which verb arity to use based on the verbs, or the ACE parse. 
+				extraFormulas.append('(FORALL a (FORALL b (IMPLIES (predicate1 a %s b) (predicate1 a %s b))))' % (w1, w2))
+				extraFormulas.append('(FORALL a (FORALL b (FORALL c (IMPLIES (predicate2 a %s b c) (predicate2 a %s b c)))))' % (w1, w2))
+				#extraFormulas.append('(FORALL a (FORALL b (FORALL c (FORALL d (IMPLIES (predicate3 a %s b c d) (predicate3 a %s b c d))))))' % (w1, w2))
+		# print("Added formulas:", extraFormulas)
+		
+		# print("About to start SE")
+		#use normal entailment. If it guesses ent. or con., then save to file and go to next pair
+		result = sentenceEntailment(fp, fh, passingFormulas=True, additionalFormulas = extraFormulas)
+		# print("RESULT (A3) WAS:", result)
+		return {'fp':fp, 'fh':fh, 'hypernyms_n':hypernyms_n, 'nonHypernyms_n':nonHypernyms_n, 'hypernyms_v':hypernyms_v,
+			'nonHypernyms_v':nonHypernyms_v, 'extraFormulas':extraFormulas, 'result':result}
+
+	stage2Outputs = cachedStage('stage2', pair, lambda: stage2(fp, fh), counters)
+	[fp, fh, extraFormulas, result] = [stage2Outputs['fp'], stage2Outputs['fh'], stage2Outputs['extraFormulas'], stage2Outputs['result']]
+	for [rule, hypernyms] in [['S1', stage2Outputs['hypernyms_n']], ['S2', stage2Outputs['hypernyms_v']]]:
+		ruleUsed = False
+		for k in hypernyms:
+			if len(hypernyms)>0:
+				ruleUsed = True
+				break
+		if ruleUsed:
+			counters['ruleCounts'].add(rule)
+	if result < 0:
+		counters['stoppedAtStage'].add(2)
+		return #call it a loss, don't count it
+	elif result > 0:
+		counters['stoppedAtStage'].add(2)
+		assessGuess(guess_values[result], correct, Ap, Ah, p, h, processId, counters, 2)
+		return
+
+
+	#############NOW TRY IT BY ADDING THE NEGATIVE RULES
+	#returns the reasoner's answer with the negative axioms added too
+	def stage3():
+		negativeFormulas = list(extraFormulas)
+		for w1 in stage2Outputs['nonHypernyms_n']:
+			for w2 in stage2Outputs['nonHypernyms_n'][w1]:
+				if w1==w2:
+					continue
+				negativeFormulas.append('(FORALL x (IFF (%s x) (NOT (%s x))))' % (w1, w2))
+		for w1 in stage2Outputs['nonHypernyms_v']:
+			for w2 in stage2Outputs['nonHypernyms_v'][w1]:
+				if w1==w2:
+					continue
+				#TODO: A smarter version of which would know which verb arity to use based on the verbs, or the ACE parse. 
+				negativeFormulas.append('(FORALL a (FORALL b (IFF (predicate1 a %s b) (NOT (predicate1 a %s b)))))' % (w1, w2))
+				negativeFormulas.append('(FORALL a (FORALL b (FORALL c (IFF (predicate2 a %s b c) (NOT (predicate2 a %s b c))))))' % (w1, w2))
+				#extraFormulas.append('(FORALL a (FORALL b (FORALL c (FORALL d (IFF (predicate3 a %s b c d) (NOT (predicate3 a %s b c d)))))))' % (w1, w2))
+		return sentenceEntailment(fp, fh, passingFormulas=True, additionalFormulas = negativeFormulas)
+
+	result = cachedStage('stage3', pair, stage3, counters)
+	# print("RESULT (A3) WAS:", result)
+	if result < 0:
+		counters['stoppedAtStage'].add(3)
+		return #call it a loss, don't count it
+	elif result > 0:
+		counters['stoppedAtStage'].add(3)
+		assessGuess(guess_values[result], correct, Ap, Ah, p, h, processId, counters, 3)
+		return
+	
+	#if we're here, it meant everybody failed to return an answer. So just guess neutral.
+	assessGuess('neutral', correct, Ap, Ah, p, h, processId, counters, 4)
+	counters['stoppedAtStage'].add(4)
+
+"""Runs the tiered algorithm on a list of SNLIPairs (skipping the ones without a gold label), writes the outcomes to the
+output files of process processId, and updates counters (created by newCounters()) in place. The dependency parses that R3
+needs are computed for all pairs in one batched call: first every pair goes through stage 0 and all rules before R3, then the
+rewritten trees are parsed together, then each pair continues from R3 on. The premise half of the work (the rules, R3 and the premise's formula)
+is only done once for the pairs that share a premise, so chunks should keep them together (see chunksByPremise()).
+"""
+def solveChunk(pairs, snlp, processId, counters, startAt):
+	startTime = time.time()
+	r3StatsBefore = dict(r3Stats)
+	numSolved = 0
+	#[pair, details, result of stage 0, Tp, Th, whether R3 still has to be applied, time spent on the rules so far, whether
+	#there was a transient failure in the rules] of the problems that weren't solved in stage 0
+	pending = []
+	#premise parse -> what its problems share: 'beforeR3' and 'rewritten' (the premise tree before and after R3), 'tree' (the
+	#rewritten tree as a ConstituencyTree), 'failed' (whether there was a transient failure in its rules) and 'fp' (see
+	#solveRewritten)
+	premises = dict()
+	for pair in pairs:
+		if pair.gold_label=='-':
+			continue #skip this problem
+		numSolved += 1
+		details = getDetails(processId, pair.index, startAt)
+		try:
+			stage0 = solveStage0(pair, processId, counters)
+			if stage0 != None:
+				[result, Tp, Th] = stage0
+				rulesStart = time.time()
+				[found, rewritten] = lookupStage('rules', pair)
+				if found:
+					pending.append([pair, details, result] + rewritten + [False, time.time() - rulesStart, False])
+				else:
+					premise = premises.setdefault(pair.sentence1_parse, {'failed':False})
+					failuresBefore = transientFailures()
+					if 'beforeR3' not in premise:
+						premise['beforeR3'] = applyRulesBeforeR3(Tp, snlp, details)
+						premise['failed'] = transientFailures() != failuresBefore
+					failuresBefore = transientFailures()
+					Th = applyRulesBeforeR3(Th, snlp, details)
+					pending.append([pair, details, result, premise['beforeR3'], Th, True, time.time() - rulesStart, transientFailures() != failuresBefore])
+		except Exception as e:
+			reportException(e, pair, details)
+	try:
+		prefetchDependencyParses([T for entry in pending if entry[5] for T in entry[3:5]], snlp)
+	except Exception as e:
+		print("Batched dependency parse failed, R3 will parse the sentences one at a time. Exception", e)
+		traceback.print_exc(file=sys.stdout)
+	for [pair, details, result, Tp, Th, needsR3, rulesSeconds, failed] in pending:
+		try:
+			rulesStart = time.time()
+			premise = premises.setdefault(pair.sentence1_parse, {'failed':False})
+			if needsR3:
+				failuresBefore = transientFailures()
+				if 'rewritten' not in premise:
+					premise['rewritten'] = applyR3(Tp, snlp, details)
+					premise['failed'] = premise['failed'] or transientFailures() != failuresBefore
+				failuresBefore = transientFailures()
+				Tp = premise['rewritten']
+				Th = applyR3(Th, snlp, details)
+				if not (failed or premise['failed'] or transientFailures() != failuresBefore):
+					storeStage('rules', pair, [Tp, Th])
+				#the rewritten premise is only read from here on, so its problems share one ConstituencyTree (and what it caches)
+				if 'tree' not in premise:
+					premise['tree'] = ConstituencyTree.fromList(premise['rewritten'])
+				Tp = premise['tree']
+			counters['rulesSeconds'].observe(rulesSeconds + time.time() - rulesStart)
+			solveRewritten(pair, result, Tp, Th, processId, counters, premise)
+		except Exception as e:
+			reportException(e, pair, details)
+	for k in r3Stats:
+		counters['r3Stats'].add(k, r3Stats[k] - r3StatsBefore[k])
+	counters['solved'].inc(numSolved)
+	counters['solveSeconds'].inc(time.time() - startTime)
+
+"""Splits pairs (SNLIPairs in file order) into lists of consecutive problems, each with at least size problems (except for the
+last one). A list goes on past size instead of separating problems with the same premise, which SNLI lists next to each
+other, so that solveChunk() can share the premise's work between them.
+"""
+def chunksByPremise(pairs, size):
+	chunk = []
+	for pair in pairs:
+		if len(chunk) >= size and pair.sentence1_parse != chunk[-1].sentence1_parse:
+			yield chunk
+			chunk = []
+		chunk.append(pair)
+	if len(chunk) > 0:
+		yield chunk
+
+#logs an exception that happened while solving problem pair
+def reportException(e, pair, details):
+	print("MESSED UP ON:")
+	print("\tPREMISE:", cleanConstituency(pair.sentence1_parse))
+	print("\tHYPOTHESIS:", cleanConstituency(pair.sentence2_parse))
+	for v in details:
+		print(v, ':', details[v])
+	resultSink(details['processId']).write('errors', [json.dumps(dict(details, exception=repr(e)))])
+	print("Exception", e)
+	traceback.print_exc(file=sys.stdout)
+
+"""Solves part processId of the dataset (out of numDivisions), in this process."""
+def runShard(processId):
+	numPerProcess = int(countPairs(SNLI_LOCATION)/numDivisions)
+	startAt = numPerProcess*processId
+	#if this shard was started before, carry on after the problems its journal says are done
+	journal = ProgressJournal(outputFile(processId, 'progress'), startAt, startAt+numPerProcess)
+	if journal.isComplete():
+		print("Process", processId, "is already done. Delete", journal.path, "to run it again.")
+		return
+	if journal.numDone > 0:
+		truncateOutputs(journal.state.get('outputSizes', dict()))
+		print("Resuming after", journal.numDone, "of", numPerProcess, "problems.")
+	else:
+		#start from scratch, so the outputs of an earlier run (without a journal, or one that was deleted) aren't mixed in
+		for kind in ['correct', 'incorrect', 'parseFails', 'errors', 'parsedSentences', 'jsonl', 'metrics']:
+			if os.path.exists(outputFile(processId, kind)):
+				os.remove(outputFile(processId, kind))
+	#only the problems left to do are read from disk
+	allPairs = [pair for pair in iterSNLI(SNLI_LOCATION, journal.firstIncomplete, startAt+numPerProcess) if not journal.isDone(pair.index)]
+
+	[snlp, cache] = setupProcess()
 	
 #	#test case for S1
 # 	p = """(ROOT (S (NP (DT A) (NN man)) (VP (VBZ hugs) (NP (DT a) (NN girl))) (. .)))"""
@@ -109,234 +685,154 @@ if __name__=="__main__":
  #    (. .)))"""
 	# correct = "contradiction"
 	
-	ruleCounts = {'S1':0, 'S2':0, 'S3':0}
-	coverage=0 #number of sentences parsed successfully
-	attempted = 0 #number of sentences tried to parse
-	score_A2 = [0,0] #times it was correct vs wrong (out of successful parses)
-	score_A3 = [0,0] #times it was correct vs wrong (out of successful parses)
-	stoppedAtStage = [0,0,0,0,0]
-	varsToStore = ['ruleCounts', 'coverage', 'attempted', 'experimentLabel', 'i', 'score_A2', 'score_A3', 'allTimes', 'processId', 'startAt', 'stoppedAtStage']
-	
-	lastTime = None
-	allTimes = [0,0] #total, sum
+	counters = newCounters()
+	counters.merge(Metrics.fromJSON(journal.state.get('metrics', dict())))
 	# for (i, [correct,p,h]) in enumerate([[correct,p,h]]):
-	with open("attempts/" + experimentLabel + '_parsedSentences_' + str(processId) + ".tsv", 'r') as F:
-		skip = len([l for l in F.readlines() if l.strip()!=''])		
-	for (i, line) in enumerate(allLines):
-		if line[0]=='-':
-			continue #skip this problem
-		if i<skip:
-			continue
-			
-		currTime = time.time()
-		if lastTime != None:
-			allTimes[0] += (currTime - lastTime)
-			allTimes[1] += 1
-		lastTime = currTime
-		
+	if cache != None:
+		print("Translating stage 0 sentences...")
+		translateStage0(allPairs)
+		print("Done.")
+	startTime = time.time()
+	lastSnapshot = startTime
+	numResumedAt = journal.numDone
+	rate = lambda: (journal.numDone - numResumedAt)/(time.time() - startTime) #problems per second since this process started
+	for chunk in chunksByPremise(allPairs, chunkSize):
+		chunkStart = chunk[0].index - startAt
+		#status report
+		if any(i%50==0 for i in range(chunkStart, chunkStart+len(chunk))):
+			reportStatus(processId, chunkStart, numPerProcess, counters, rate(), cache)
+			lastSnapshot = time.time()
 		try:
-			#######FIRST, Try it without applying any rules
-			correct = line[0]
-			p = line[3] #constituency parse of premise
-			h = line[4] #constituency parse of hypothesis
-			p_raw = line[5] #raw text of premise
-			h_raw = line[6] #raw text of hypothesis
-
-			#clean them up for punctuation and shit
-			for punct in ['(. ,)', '(. .)', '(. !)']:
-				p = p.replace(punct, '')
-				h = h.replace(punct, '')
-			p = p.replace('.', '')
-			h = h.replace('.', '')
-
-			guess_values = ['neutral', 'entailment', 'contradiction']
-
-			#status report
-			if i%50==0:
-				print("\n\nPROCESS", processId, "ON ITERATION", i, "of", len(allLines), ":")
-				if allTimes[1]>0:
-					print("\tAverage time per problem:", allTimes[0]/allTimes[1])
-				for v in varsToStore:
-					print('\t', v, ':', eval(v))
-				with open("attempts/" + experimentLabel + '_' + str(processId) +  "_errors.txt", 'a') as F:
-					F.write(str({v:eval(v) for v in varsToStore}) + '\n')
-
-			# print("p is:", p)
-			# print("p_raw is:", p_raw)
-			# print("h is:", h)
-			# print("h_raw is:", h_raw)
-			# print("correct is:", correct)
-
-			Tp = parseConstituency(p)
-			Th = parseConstituency(h)
-
-			def assessGuess(guess, correct, Tp, Th, p, h):
-				# print("Correct:", correct, "My guess:", guess)
-				# input("Press enter...")
-				if correct==guess:
-					with open("attempts/" + experimentLabel + '_' + str(processId) + "_correct.txt", 'a') as F:
-						F.write('\t'.join([correct, treeToACEInput(Tp), treeToACEInput(Th), p, h]).strip() + '\n')
-				else:
-					with open("attempts/" + experimentLabel + '_' + str(processId) + "_incorrect.txt", 'a') as F:
-						F.write('\t'.join([correct, guess, treeToACEInput(Tp), treeToACEInput(Th), p, h]).strip() + '\n')
-			# print("ORIGINAL:")
-			# print('\tP:'+' '.join(treeToACEInput(Tp)))
-			# print('\tH:'+' '.join(treeToACEInput(Th)))
-			attempted += 2
-			#let's see if, before applying any rules whatsoever, it can parse and make a guess
-			result = sentenceEntailment(treeToACEInput(Tp), treeToACEInput(Th))
-			if result > 0: #if it guessed 'entailment' or 'contradiction'
-				stoppedAtStage[0] += 1
-				coverage += 2
-				assessGuess(guess_values[result], correct, Tp, Th, p, h)
-				continue
-
-			##########NEXT, APPLY THE SYNTACTIC RULES
-			Tp = applySyntacticRules(Tp, snlp, varsToStore)
-			Th = applySyntacticRules(Th, snlp, varsToStore)
-
-			#get the parsed formulas. 
-			def parseTree(T): #T = a constituency parse tree
-				A = treeToACEInput(T)
-				tptp = sentenceToTPTP(A)
-				if tptp==None:
-					return None
-				return tptpsToSexp(tptp, returnList=True)
-
-			fp = compressFormulaTree(parseTree(Tp))
-			fh = compressFormulaTree(parseTree(Th))
-
-			# print("\nEntailment between:\n\t", Tp, "\n\t", Th)
-
-			#TODO: record fp and fh, regardless of whether they parsed
-			with open("attempts/" + experimentLabel + '_parsedSentences_' + str(processId) + ".tsv", 'a') as F:
-				fp_str = "None" if (fp==None) else propStructToSExp(fp)
-				fh_str = "None" if (fh==None) else propStructToSExp(fh)
-				F.write('\t'.join([p_raw, h_raw, correct, fp_str, fh_str]) + '\n')
-
-			#use normal entailment. If it guesses ent. or con., then save to file and go to next pair
-			if None in [fp,fh]: #at least one sentence failed to parse still
-				stoppedAtStage[1] += 1
-				if result==-1: #at least one sentence parsed successfully
-					coverage += 1
-				with open("attempts/" + experimentLabel + '_' + str(processId) + "_parseFails.txt", 'a') as F:
-					F.write('\t'.join([correct, treeToACEInput(Tp), treeToACEInput(Th), p, h]).strip() + '\n')
-				continue #call it a loss, don't count it
-			#if we're here, then both sentences now parse!
-			coverage += 2
-			result = sentenceEntailment(fp, fh, passingFormulas=True)#sentenceEntailment(treeToACEInput(Tp), treeToACEInput(Th))
-			if result > 0: #did the reasoner make a guess of non-neutral?
-				stoppedAtStage[1] += 1
-				assessGuess(guess_values[result], correct, Tp, Th, p, h)
-				continue
-
-			##########FINALLY, TRY IT WITH THE SEMANTIC RULES
-
-			#####S3#########
-			Tp_unmodified = R9(parseConstituency(p))[1] #apply R9 to fix sentence fragments, but nothing else
-			Th_unmodified = R9(parseConstituency(h))[1]
-			# print("Original sentences:", '\n\t', treeToACEInput(Tp_unmodified), '\n\t', treeToACEInput(Th_unmodified))
-			# print("Sentences after transforms:", '\n\t', treeToACEInput(Tp), '\n\t', treeToACEInput(Th))
-			# print("Original formulas:", '\n\t', fp, '\n\t', fh)
-			[fp, fh] = S3(Tp_unmodified, Th_unmodified, fp, fh)
-			# print("S3 formulas:", '\n\t', fp, '\n\t', fh)
-			# input("Press enter...")
-			fp = treeToSexp(fp)
-			fh = treeToSexp(fh)
-
-			# print("About to start S1")
-			#####S1#########
-			[hypernyms, nonHypernyms_n] = S1(Tp, Th)
-			ruleUsed = False
-			for k in hypernyms:
-				if len(hypernyms)>0:
-					ruleUsed = True
-					break
-			if ruleUsed:
-				ruleCounts['S1'] += 1
-			
-			extraFormulas = []
-			for w1 in hypernyms:
-				for w2 in hypernyms[w1]:
-					if w1==w2:
-						continue
-					extraFormulas.append('(FORALL x (IMPLIES (%s x) (%s x)))' % (w1, w2))
-			#####S2#########
-			[hypernyms, nonHypernyms_v] = S2(Tp, Th)
-			ruleUsed = False
-			for k in hypernyms:
-				if len(hypernyms)>0:
-					ruleUsed = True
-					break
-			if ruleUsed:
-				ruleCounts['S2'] += 1
-			
-			for w1 in hypernyms:
-				for w2 in hypernyms[w1]:
-					if w1==w2:
-						continue
-					#TODO: A smarter version of which would know which verb arity to use based on the verbs, or the ACE parse. 
-					extraFormulas.append('(FORALL a (FORALL b (IMPLIES (predicate1 a %s b) (predicate1 a %s b))))' % (w1, w2))
-					extraFormulas.append('(FORALL a (FORALL b (FORALL c (IMPLIES (predicate2 a %s b c) (predicate2 a %s b c)))))' % (w1, w2))
-					#extraFormulas.append('(FORALL a (FORALL b (FORALL c (FORALL d (IMPLIES (predicate3 a %s b c d) (predicate3 a %s b c d))))))' % (w1, w2))
-			# print("Added formulas:", extraFormulas)
-			
-			# print("About to start SE")
-			#use normal entailment. If it guesses ent. or con., then save to file and go to next pair
-			result = sentenceEntailment(fp, fh, passingFormulas=True, additionalFormulas = extraFormulas)
-			# print("RESULT (A3) WAS:", result)
-			if result < 0:
-				stoppedAtStage[2] += 1
-				continue #call it a loss, don't count it
-			elif result > 0:
-				stoppedAtStage[2] += 1
-				assessGuess(guess_values[result], correct, Tp, Th, p, h)
-				continue
-
-
-			#############NOW TRY IT BY ADDING THE NEGATIVE RULES
-			for w1 in nonHypernyms_n:
-				for w2 in nonHypernyms_n[w1]:
-					if w1==w2:
-						continue
-					extraFormulas.append('(FORALL x (IFF (%s x) (NOT (%s x))))' % (w1, w2))
-			for w1 in nonHypernyms_v:
-				for w2 in nonHypernyms_v[w1]:
-					if w1==w2:
-						continue
-					#TODO: A smarter version of which would know which verb arity to use based on the verbs, or the ACE parse. 
-					extraFormulas.append('(FORALL a (FORALL b (IFF (predicate1 a %s b) (NOT (predicate1 a %s b)))))' % (w1, w2))
-					extraFormulas.append('(FORALL a (FORALL b (FORALL c (IFF (predicate2 a %s b c) (NOT (predicate2 a %s b c))))))' % (w1, w2))
-					#extraFormulas.append('(FORALL a (FORALL b (FORALL c (FORALL d (IFF (predicate3 a %s b c d) (NOT (predicate3 a %s b c d)))))))' % (w1, w2))
-			result = sentenceEntailment(fp, fh, passingFormulas=True, additionalFormulas = extraFormulas)
-			# print("RESULT (A3) WAS:", result)
-			if result < 0:
-				stoppedAtStage[3] += 1
-				continue #call it a loss, don't count it
-			elif result > 0:
-				stoppedAtStage[3] += 1
-				assessGuess(guess_values[result], correct, Tp, Th, p, h)
-				continue
-			
-			#if we're here, it meant everybody failed to return an answer. So just guess neutral.
-			assessGuess('neutral', correct, Tp, Th, p, h)
-			stoppedAtStage[4] += 1
+			solveChunk(chunk, snlp, processId, counters, startAt)
+			#the outputs of the chunk are on disk before the journal says it is done
+			resultSink(processId).checkpoint()
+			journal.markDone(pair.index for pair in chunk)
+			journal.state = {'metrics':counters.toJSON(), 'outputSizes':outputSizes(processId)}
+			journal.save()
 		except KeyboardInterrupt:
+			closeResultSinks()
 			exit()
-		except Exception as e:
-			print("MESSED UP ON:")
-			print("\tPREMISE:", p)
-			print("\tHYPOTHESIS:", h)
-			for v in varsToStore:
-				print(v, ':', eval(v))
-			with open("attempts/" + experimentLabel + '_' + str(processId) + "_errors.txt", 'a') as F:
-				F.write(str({v:eval(v) for v in varsToStore}) + '\n')
-			print("Exception", e)
-			traceback.print_exc(file=sys.stdout)
-# 			input("Press enter to continue...")
-			continue
+		if time.time() - lastSnapshot >= metricsInterval:
+			writeMetrics(processId, counters, journal.numDone, numPerProcess, rate())
+			lastSnapshot = time.time()
+	print("\nCOMPLETED SUCCESSFULLY!")
+	for [v, value] in counters.summary().items():
+		print(v, ':', value)
+	if cache != None:
+		print('TPTP cache :', cache.stats())
+	if stageCache != None:
+		print('stage cache :', stageCache.stats())
+	writeMetrics(processId, counters, journal.numDone, numPerProcess, rate())
+	closeResultSinks()
+
+#state of a worker process in parallel mode, set up once by _initWorker()
+_worker = dict()
+
+def _initWorker(workerCount):
+	with workerCount.get_lock():
+		_worker['processId'] = 'p' + str(workerCount.value)
+		workerCount.value += 1
+	[_worker['snlp'], _worker['cache']] = setupProcess()
+	#pool workers don't run atexit handlers, so make sure the APE processes are stopped (and the hypernym cache is saved) when the worker exits
+	multiprocessing.util.Finalize(None, stopAPEWorkers, exitpriority=10)
+	multiprocessing.util.Finalize(None, closeResultSinks, exitpriority=10)
+	if hypernymCacheLocation != None:
+		multiprocessing.util.Finalize(None, saveHypernymCache, args=(hypernymCacheLocation,), exitpriority=10)
+
+#solves the problems with index startAt <= i < stopAt, except the ones in skip (which are done already), in a worker process.
+#Returns [chunk, counters, number of problems] for the chunk, and the sizes of the worker's output files once they are
+#written (see outputSizes()).
+def _solveChunk(chunk):
+	[startAt, stopAt, skip] = chunk
+	skip = set(skip)
+	processId = _worker['processId']
+	counters = newCounters()
+	pairs = [pair for pair in iterSNLI(SNLI_LOCATION, startAt, stopAt) if pair.index not in skip]
+	if _worker['cache'] != None:
+		translateStage0(pairs)
+	solveChunk(pairs, _worker['snlp'], processId, counters, startAt)
+	resultSink(processId).checkpoint() #the parent merges the output files when all chunks are done
+	return [chunk, counters, len(pairs), outputSizes(processId)]
+
+"""Solves the whole dataset with numWorkers worker processes. Problems are handed out in chunks of chunkSize to whichever
+worker is free. At the end, the output files of all workers are concatenated into the files of processId 'all'. The
+counters of the chunks are merged as they come in, and written to the 'all' metrics file every metricsInterval seconds.
+The chunks that are done are recorded in a progress journal, so if the run is stopped before the end, running it again
+carries on with the chunks that weren't done (and keeps the outputs of the ones that were). Once the outputs are merged, the
+journal is removed, and the next run starts from scratch.
+"""
+def runParallel(numWorkers):
+	numPairs = countPairs(SNLI_LOCATION) #builds the line index before the workers need it
+	kinds = outputKinds()
+	journal = ProgressJournal(outputFile('all', 'progress'), 0, numPairs)
+	workerSizes = journal.state.get('outputSizes', dict()) #file of a worker -> its size after the last chunk in the journal
+	for kind in kinds:
+		for f in glob.glob(outputFile('p[0-9]*', kind)):
+			if f not in workerSizes:
+				os.remove(f) #start from scratch, so outputs of a previous run don't get merged in
+		if os.path.exists(outputFile('all', kind)):
+			os.remove(outputFile('all', kind))
+	if journal.numDone == 0 and os.path.exists(outputFile('all', 'metrics')):
+		os.remove(outputFile('all', 'metrics'))
+	truncateOutputs(workerSizes)
+	if journal.numDone > 0:
+		print("Resuming after", journal.numDone, "of", numPairs, "problems.")
+
+	#the workers read their problems themselves, this only decides which ones each chunk has: [where it starts, where it
+	#stops, the problems in between that are done already]. The problems the journal has are left out one by one, so a
+	#journal from a run with a different chunkSize is resumed without solving any of them again.
+	pending = (pair for pair in iterSNLI(SNLI_LOCATION, journal.firstIncomplete) if not journal.isDone(pair.index))
+	chunks = ([chunk[0].index, chunk[-1].index+1, sorted(set(range(chunk[0].index, chunk[-1].index+1)) - set(pair.index for pair in chunk))]
+		for chunk in chunksByPremise(pending, chunkSize))
+	counters = newCounters()
+	counters.merge(Metrics.fromJSON(journal.state.get('metrics', dict())))
+	numDone = journal.numDone
+	numResumedAt = numDone
+	lastReport = numDone
+	startTime = time.time()
+	lastSnapshot = startTime
+	rate = lambda: (numDone - numResumedAt)/(time.time() - startTime) #problems per second since this run started
+	pool = multiprocessing.Pool(numWorkers, initializer=_initWorker, initargs=(multiprocessing.Value('i', 0),))
+	try:
+		for [chunk, chunkCounters, chunkLength, chunkSizes] in pool.imap_unordered(_solveChunk, chunks):
+			counters.merge(chunkCounters)
+			numDone += chunkLength
+			workerSizes.update(chunkSizes)
+			journal.markDone(range(chunk[0], chunk[1]))
+			journal.state = {'metrics':counters.toJSON(), 'outputSizes':workerSizes}
+			journal.save()
+			if numDone - lastReport >= 50*numWorkers:
+				lastReport = numDone
+				print("\n\nDONE WITH", min(numDone, numPairs), "of", numPairs, "PROBLEMS (%.2f problems/sec)" % rate())
+				for [v, value] in counters.summary().items():
+					print('\t', v, ':', value)
+			if time.time() - lastSnapshot >= metricsInterval:
+				writeMetrics('all', counters, numDone, numPairs, rate())
+				lastSnapshot = time.time()
+	finally:
+		pool.close()
+		pool.join()
+
+	#merge the outputs of all workers. The workers' files are only removed after the journal, so if this is interrupted,
+	#the next run either merges them again or starts over.
+	workerFiles = []
+	for kind in kinds:
+		with open(outputFile('all', kind), 'w') as out:
+			for f in sorted(glob.glob(outputFile('p[0-9]*', kind))):
+				with open(f, 'r') as F:
+					out.write(F.read())
+				workerFiles.append(f)
+	journal.remove()
+	for f in workerFiles:
+		os.remove(f)
 	print("\nCOMPLETED SUCCESSFULLY!")
-	for v in varsToStore:
-		print(v, ':', eval(v))
-	with open("attempts/" + experimentLabel + '_' + str(processId) + "_errors.txt", 'a') as F:
-		F.write(str({v:eval(v) for v in varsToStore}) + '\n')
\ No newline at end of file
+	for [v, value] in counters.summary().items():
+		print(v, ':', value)
+	writeMetrics('all', counters, numDone, numPairs, rate())
+	closeResultSinks()
+
+if __name__=="__main__":
+	if sys.argv[1]=='parallel':
+		runParallel(int(sys.argv[2]) if len(sys.argv)>2 else numWorkers)
+	else:
+		runShard(int(sys.argv[1]))
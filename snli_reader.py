@@ -0,0 +1,82 @@
+"""
+Streaming access to the SNLI dataset, so that a process only reads the problems it is going to solve instead of loading the
+whole corpus into memory. Works with both the .txt (tab-separated) and the .jsonl versions of SNLI.
+
+The first time a file is read, a line-offset index is built and saved next to it (e.g. snli_1.0_train.txt.idx), which lets
+iterSNLI() seek directly to the start of a shard.
+"""
+import json
+import os
+from array import array
+from collections import namedtuple
+
+#one SNLI problem. index = its position in the file (0 = first problem after the header)
+SNLIPair = namedtuple('SNLIPair', ['index', 'gold_label', 'sentence1_parse', 'sentence2_parse', 'sentence1', 'sentence2', 'pairID'])
+
+_loadedIndices = dict() #path -> array of offsets, so each process only reads an index once
+
+def isJsonl(path):
+	return path.endswith('.jsonl')
+
+def _parseLine(index, line, jsonl):
+	if jsonl:
+		d = json.loads(line)
+		return SNLIPair(index, d['gold_label'], d['sentence1_parse'], d['sentence2_parse'], d['sentence1'], d['sentence2'], d.get('pairID'))
+	cols = line.strip().split('\t')
+	return SNLIPair(index, cols[0], cols[3], cols[4], cols[5], cols[6], cols[8] if len(cols)>8 else None)
+
+"""Scans path once and writes the byte offset of every problem to path + '.idx'. Returns the offsets."""
+def buildLineIndex(path):
+	offsets = array('Q')
+	with open(path, 'rb') as F:
+		if not isJsonl(path):
+			F.readline() #skip the header
+		while True:
+			pos = F.tell()
+			line = F.readline()
+			if not line:
+				break
+			if line.strip() != b'':
+				offsets.append(pos)
+	tmp = path + '.idx.' + str(os.getpid()) + '.tmp' #several processes may build the index at the same time
+	with open(tmp, 'wb') as F:
+		offsets.tofile(F)
+	os.replace(tmp, path + '.idx')
+	return offsets
+
+"""Returns the offsets of all problems in path, building the index file if it doesn't exist or is older than the data."""
+def loadLineIndex(path):
+	if path in _loadedIndices:
+		return _loadedIndices[path]
+	indexPath = path + '.idx'
+	if not os.path.exists(indexPath) or os.path.getmtime(indexPath) < os.path.getmtime(path):
+		offsets = buildLineIndex(path)
+	else:
+		offsets = array('Q')
+		with open(indexPath, 'rb') as F:
+			offsets.frombytes(F.read())
+	_loadedIndices[path] = offsets
+	return offsets
+
+def countPairs(path):
+	return len(loadLineIndex(path))
+
+"""Yields the problems in path with index start <= i < stop (stop=None: until the end of the file) as SNLIPairs."""
+def iterSNLI(path, start=0, stop=None):
+	offsets = loadLineIndex(path)
+	if stop == None or stop > len(offsets):
+		stop = len(offsets)
+	if start >= stop:
+		return
+	jsonl = isJsonl(path)
+	with open(path, 'r', encoding='utf-8') as F:
+		F.seek(offsets[start])
+		i = start
+		while i < stop:
+			line = F.readline()
+			if not line:
+				break
+			if line.strip() == '':
+				continue
+			yield _parseLine(i, line, jsonl)
+			i += 1
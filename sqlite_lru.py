@@ -0,0 +1,80 @@
+"""
+The SQLite storage that tptp_cache.TPTPCache and stage_cache.StageCache share: a table of entries with a text key, some
+value columns and the time each entry was last used, in a database file that several processes can use at once (in WAL
+mode). Once it holds more than maxEntries, the least recently used entries are evicted.
+
+Lookups don't write to the database: the times entries were last used are kept in memory, and written in one transaction
+every touchBatchSize hits, on _store() and on close().
+"""
+import sqlite3
+import threading
+import time
+
+class SQLiteLRUCache:
+	"""table = the name of the table, columns = the value columns with their types, e.g. ['sentence TEXT', 'tptp TEXT']."""
+	def __init__(self, path, table, columns, maxEntries=2000000, touchBatchSize=1000):
+		self.path = path
+		self.table = table
+		self.columnNames = [c.split()[0] for c in columns]
+		self.maxEntries = maxEntries
+		self.touchBatchSize = touchBatchSize
+		self.touched = dict() #key -> when it was last used, not written to the database yet
+		self.lock = threading.Lock()
+		self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+		self.conn.execute("PRAGMA journal_mode=WAL")
+		self.conn.execute("CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, %s, lastUsed REAL)" % (table, ', '.join(columns)))
+		self.conn.execute("CREATE INDEX IF NOT EXISTS %s_lastUsed ON %s (lastUsed)" % (table, table))
+		self.conn.commit()
+		self.numEntries = self.conn.execute("SELECT COUNT(*) FROM %s" % table).fetchone()[0]
+
+	"""Returns the value of column for key, as a 1-tuple, or None if there is no entry for key."""
+	def _lookup(self, key, column):
+		with self.lock:
+			row = self.conn.execute("SELECT %s FROM %s WHERE key=?" % (column, self.table), (key,)).fetchone()
+			if row != None:
+				self.touched[key] = time.time()
+				if len(self.touched) >= self.touchBatchSize:
+					self._writeTouched()
+					self.conn.commit()
+			return row
+
+	def _contains(self, key):
+		with self.lock:
+			return self.conn.execute("SELECT 1 FROM %s WHERE key=?" % self.table, (key,)).fetchone() != None
+
+	"""Stores values (one for each of the columns) under key, replacing what was there."""
+	def _store(self, key, values):
+		names = ', '.join(self.columnNames)
+		with self.lock:
+			self._writeTouched()
+			cur = self.conn.execute("INSERT OR IGNORE INTO %s (key, %s, lastUsed) VALUES (?, %s, ?)" % (self.table, names, ', '.join(['?']*len(values))),
+				[key] + list(values) + [time.time()])
+			if cur.rowcount > 0:
+				self.numEntries += 1
+			else: #another process (or an earlier run) stored it already
+				self.conn.execute("UPDATE %s SET %s, lastUsed=? WHERE key=?" % (self.table, ', '.join(n + '=?' for n in self.columnNames)),
+					list(values) + [time.time(), key])
+			if self.numEntries > self.maxEntries:
+				self._evict()
+			self.conn.commit()
+
+	#writes the times in self.touched to the database (without committing)
+	def _writeTouched(self):
+		if len(self.touched) > 0:
+			self.conn.executemany("UPDATE %s SET lastUsed=? WHERE key=?" % self.table, [(t, k) for (k, t) in self.touched.items()])
+			self.touched = dict()
+
+	#removes the least recently used entries. Evicts 10% more than needed, so this doesn't run on every _store().
+	def _evict(self):
+		self.numEntries = self.conn.execute("SELECT COUNT(*) FROM %s" % self.table).fetchone()[0]
+		numToRemove = self.numEntries - int(self.maxEntries*0.9)
+		if numToRemove <= 0:
+			return
+		self.conn.execute("DELETE FROM %s WHERE key IN (SELECT key FROM %s ORDER BY lastUsed LIMIT ?)" % (self.table, self.table), (numToRemove,))
+		self.numEntries -= numToRemove
+
+	def close(self):
+		with self.lock:
+			self._writeTouched()
+			self.conn.commit()
+			self.conn.close()
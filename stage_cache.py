@@ -0,0 +1,51 @@
+"""
+A persistent cache of what each stage of run_S3's pipeline computed for each SNLI problem (the rewritten trees, the formulas,
+the axioms added by S1-S3, and the reasoner's answers), so that rerunning an experiment only recomputes the stages whose code
+changed.
+
+Entries are keyed by a hash of the problem's premise and hypothesis parses, the name of the stage, and the version tags of
+that stage and every stage before it (plus a base version, e.g. the APE lexicon's). Bumping the version of one stage therefore
+invalidates it and all the stages after it, and a rerun resumes from there. Values are pickled. Once the cache holds more than
+maxEntries, the least recently used entries are evicted (see sqlite_lru.SQLiteLRUCache). It is safe to share one cache file
+between several processes.
+"""
+import hashlib
+import pickle
+from sqlite_lru import SQLiteLRUCache
+
+class StageCache(SQLiteLRUCache):
+	"""versions = [[stage name, version tag], ...], in the order the stages run."""
+	def __init__(self, path, versions, baseVersion='', maxEntries=2000000, touchBatchSize=1000):
+		SQLiteLRUCache.__init__(self, path, 'stages', ['stage TEXT', 'value BLOB'], maxEntries, touchBatchSize)
+		self.hits = dict() #stage name -> number of lookups that found an entry
+		self.misses = dict()
+		#the tag of each stage covers the versions of all the stages before it
+		self.tags = dict()
+		tag = baseVersion
+		for [stage, version] in versions:
+			tag += '\n' + stage + '=' + str(version)
+			self.tags[stage] = tag
+			self.hits[stage] = 0
+			self.misses[stage] = 0
+
+	def key(self, stage, premise, hypothesis):
+		return hashlib.sha256((self.tags[stage] + '\n' + premise + '\n' + hypothesis).encode('utf-8')).hexdigest()
+
+	"""Returns [found, value], where value is what was stored for stage on this problem if found is True."""
+	def get(self, stage, premise, hypothesis):
+		row = self._lookup(self.key(stage, premise, hypothesis), 'value')
+		if row == None:
+			self.misses[stage] += 1
+			return [False, None]
+		self.hits[stage] += 1
+		return [True, pickle.loads(row[0])]
+
+	"""Returns True if something is stored for stage on this problem, without counting it as a lookup."""
+	def contains(self, stage, premise, hypothesis):
+		return self._contains(self.key(stage, premise, hypothesis))
+
+	def put(self, stage, premise, hypothesis, value):
+		self._store(self.key(stage, premise, hypothesis), [stage, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)])
+
+	def stats(self):
+		return {stage:{'hits':self.hits[stage], 'misses':self.misses[stage]} for stage in self.tags}
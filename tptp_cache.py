@@ -0,0 +1,43 @@
+"""
+A persistent, content-addressed cache of ACE -> TPTP translations, so that sentences APE has already seen (e.g. SNLI premises,
+which appear with three hypotheses each, or anything translated in a previous run) don't have to be parsed again.
+
+Entries are keyed by a hash of the ACE text plus a lexicon version string, so changing clex_lexicon.pl invalidates them.
+Sentences APE could not parse are stored too (as negative entries). Once the cache holds more than maxEntries, the least
+recently used entries are evicted (see sqlite_lru.SQLiteLRUCache). It is safe to share one cache file between several
+processes.
+"""
+import hashlib
+from sqlite_lru import SQLiteLRUCache
+
+class TPTPCache(SQLiteLRUCache):
+	def __init__(self, path, lexiconVersion='', maxEntries=2000000, touchBatchSize=1000):
+		SQLiteLRUCache.__init__(self, path, 'tptp', ['sentence TEXT', 'tptp TEXT'], maxEntries, touchBatchSize)
+		self.lexiconVersion = lexiconVersion
+		self.hits = 0 #lookups that found a translation
+		self.negativeHits = 0 #lookups that found a stored parse failure
+		self.misses = 0
+
+	def key(self, sentence):
+		return hashlib.sha256((self.lexiconVersion + '\n' + sentence).encode('utf-8')).hexdigest()
+
+	"""Returns [found, tptp]. If found is True, tptp is the cached translation, or None if APE failed to parse the sentence."""
+	def get(self, sentence):
+		row = self._lookup(self.key(sentence), 'tptp')
+		if row == None:
+			self.misses += 1
+			return [False, None]
+		if row[0] == None:
+			self.negativeHits += 1
+		else:
+			self.hits += 1
+		return [True, row[0]]
+
+	"""Stores the translation of sentence. tptp=None records a parse failure."""
+	def put(self, sentence, tptp):
+		self._store(self.key(sentence), [sentence, tptp])
+
+	def stats(self):
+		lookups = self.hits + self.negativeHits + self.misses
+		return {'hits':self.hits, 'negativeHits':self.negativeHits, 'misses':self.misses,
+			'hitRate':(self.hits + self.negativeHits)/lookups if lookups>0 else 0.0, 'entries':self.numEntries}
@@ -1,22 +1,61 @@
-from nltk.corpus import wordnet as wn
+from collections import OrderedDict
+from array import array
+import atexit
+import pickle
+import os
+import sys
+import mmap
+import struct
+import bisect
 
-def findHypernym_onedir(word1,word2,pos='n'):
-	toCheck = [s for s in wn.synsets(word1) if s.pos()==pos]
+hypernymIndexLocation = "wordnet_hypernyms.idx" #built by `python wordnet_utils.py build`. If it exists, queries are answered from it without loading nltk.
+
+closureCacheSize = 100000 #maximum number of (word, pos) closures kept in memory
+_closures = OrderedDict() #(word, pos) -> frozenset of lemma names, least recently used first
+
+_wn = None
+#nltk (and the WordNet database) is only loaded when a query can't be answered from the hypernym index
+def _wordnet():
+	global _wn
+	if _wn == None:
+		from nltk.corpus import wordnet
+		_wn = wordnet
+	return _wn
+
+"""Returns the names of all lemmas of word's synsets with part of speech pos, and of all of their (transitive) hypernyms
+with the same part of speech, as something that supports `name in closure`. If word is a WordNet lemma and the hypernym
+index exists, this is answered from the index; otherwise WordNet is walked once and the result is memoized.
+"""
+def hypernymClosure(word, pos='n'):
+	index = getHypernymIndex()
+	if index != None:
+		closure = index.closure(word, pos)
+		if closure != None:
+			return closure
+	key = (word, pos)
+	if key in _closures:
+		_closures.move_to_end(key)
+		return _closures[key]
+	names = set()
+	toCheck = [s for s in _wordnet().synsets(word) if s.pos()==pos]
 	alreadyChecked = set()
 	while len(toCheck)>0:
-		s = toCheck.pop(0)
-# 		print("Checking node:", s)
+		s = toCheck.pop()
 		if s in alreadyChecked:
 			continue
-		else:
-			alreadyChecked.add(s)
-# 		print("\tLemmas:", [l.name() for l in s.lemmas()])
-		if word2 in [l.name() for l in s.lemmas()]:
-			return True
-		toCheck = toCheck + [h for h in s.hypernyms() if h.pos()==pos]
-	return False
-		
-"""If one word is a parent class of another, then this returns a 
+		alreadyChecked.add(s)
+		names.update(l.name() for l in s.lemmas())
+		toCheck.extend(h for h in s.hypernyms() if h.pos()==pos)
+	closure = frozenset(names)
+	_closures[key] = closure
+	if len(_closures) > closureCacheSize:
+		_closures.popitem(last=False)
+	return closure
+
+def findHypernym_onedir(word1,word2,pos='n'):
+	return word2 in hypernymClosure(word1, pos)
+
+"""If one word is a parent class of another, then this returns a
 pair [wc,wp] where wp is the parent class of wc. Note that quantity
 is essentially ignored.
 """
@@ -30,5 +69,167 @@ def findHypernym(w1,w2,pos='n'):
 		return [w2,w1]
 	return None
 
+"""Returns a matrix M (a list of lists of booleans) where M[i][j] is True iff findHypernym_onedir(words[i], words[j], pos),
+i.e. words[j] is one of words[i]'s hypernyms. The closure of each word is looked up once, so building the matrix costs
+one closure per word plus a set lookup per ordered pair. The transpose M[j][i] answers the reverse question.
+"""
+def hypernymMatrix(words, pos='n'):
+	closures = [hypernymClosure(w, pos) for w in words]
+	return [[w2 in closure for w2 in words] for closure in closures]
+
+"""Adds the closures saved in path (by saveHypernymCache) to the in-memory cache."""
+def loadHypernymCache(path):
+	if not os.path.exists(path):
+		return
+	with open(path, 'rb') as F:
+		saved = pickle.load(F)
+	for (key, closure) in saved.items():
+		if key not in _closures:
+			_closures[key] = closure
+	while len(_closures) > closureCacheSize:
+		_closures.popitem(last=False)
+
+"""Saves the in-memory closures to path, keeping whatever other processes have already saved there."""
+def saveHypernymCache(path):
+	loadHypernymCache(path)
+	tmp = path + '.' + str(os.getpid()) + '.tmp'
+	with open(tmp, 'wb') as F:
+		pickle.dump(dict(_closures), F)
+	os.replace(tmp, path)
+
+"""Loads the closures saved in path now, and saves them (plus everything computed in the meantime) when the program exits,
+so the next run starts with a warm cache."""
+def persistHypernymCache(path):
+	loadHypernymCache(path)
+	atexit.register(saveHypernymCache, path)
+
+"""The hypernym closures of every noun and verb lemma in WordNet, stored in a file that is memory-mapped rather than read
+(see buildHypernymIndex for the layout). All lemma names are numbered in sorted order; for each part of speech, the closure
+of the lemma with number i is the sorted list of numbers ids[offsets[i]:offsets[i+1]].
+"""
+class HypernymIndex:
+	MAGIC = b'WNHYPIDX'
+	HEADER = '=8sIIII' #magic, number of names, length of the names blob, number of noun ids, number of verb ids
+	POS = ['n', 'v']
+
+	def __init__(self, path):
+		with open(path, 'rb') as F:
+			self.mm = mmap.mmap(F.fileno(), 0, access=mmap.ACCESS_READ)
+		[magic, numNames, namesLength, numIds_n, numIds_v] = struct.unpack_from(self.HEADER, self.mm, 0)
+		if magic != self.MAGIC:
+			raise Exception("Not a hypernym index file: " + path)
+		pos = struct.calcsize(self.HEADER)
+		self.names = self.mm[pos:pos+namesLength].decode('utf-8').split('\n')
+		self.nameIds = {n:i for (i,n) in enumerate(self.names)}
+		pos += namesLength + (-namesLength % 4)
+		view = memoryview(self.mm)
+		self.offsets = dict()
+		self.ids = dict()
+		for p in self.POS:
+			self.offsets[p] = view[pos:pos + 4*(numNames+1)].cast('I')
+			pos += 4*(numNames+1)
+		for (p, numIds) in [['n', numIds_n], ['v', numIds_v]]:
+			self.ids[p] = view[pos:pos + 4*numIds].cast('I')
+			pos += 4*numIds
+
+	#returns the closure of word, or None if word is not a lemma with part of speech pos
+	def closure(self, word, pos):
+		if pos not in self.offsets:
+			return None
+		i = self.nameIds.get(word.lower())
+		if i == None:
+			return None
+		offsets = self.offsets[pos]
+		if offsets[i] == offsets[i+1]:
+			return None
+		return _IndexedClosure(self, self.ids[pos][offsets[i]:offsets[i+1]])
+
+class _IndexedClosure:
+	def __init__(self, index, ids):
+		self.index = index
+		self.ids = ids
+
+	def __contains__(self, name):
+		i = self.index.nameIds.get(name)
+		if i == None:
+			return False
+		j = bisect.bisect_left(self.ids, i)
+		return j < len(self.ids) and self.ids[j] == i
+
+	def __iter__(self):
+		return (self.index.names[i] for i in self.ids)
+
+	def __len__(self):
+		return len(self.ids)
+
+_index = None
+_indexLoaded = False
+
+"""Returns the HypernymIndex at hypernymIndexLocation, or None if there isn't one."""
+def getHypernymIndex():
+	global _index, _indexLoaded
+	if not _indexLoaded:
+		_indexLoaded = True
+		if hypernymIndexLocation != None and os.path.exists(hypernymIndexLocation):
+			_index = HypernymIndex(hypernymIndexLocation)
+	return _index
+
+"""Walks all noun and verb synsets of WordNet once and writes the hypernym closure of every lemma to path.
+Layout (native byte order): header (HypernymIndex.HEADER), the sorted names joined by newlines (padded to a multiple of
+4 bytes), the noun and verb offsets (uint32, one more than the number of names), then the noun and verb ids (uint32).
+"""
+def buildHypernymIndex(path):
+	wn = _wordnet()
+	synsetClosures = dict()
+	def synsetClosure(s):
+		if s not in synsetClosures:
+			names = set(l.name() for l in s.lemmas())
+			for h in s.hypernyms():
+				if h.pos()==s.pos():
+					names |= synsetClosure(h)
+			synsetClosures[s] = frozenset(names)
+		return synsetClosures[s]
+	closures = dict()
+	allNames = set()
+	for pos in HypernymIndex.POS:
+		closures[pos] = dict()
+		for lemma in wn.all_lemma_names(pos):
+			#same synsets that hypernymClosure() would walk, including the ones morphy finds for inflected-looking lemmas
+			synsets = [s for s in wn.synsets(lemma) if s.pos()==pos]
+			closure = set()
+			for s in synsets:
+				closure |= synsetClosure(s)
+			closures[pos][lemma] = closure
+			allNames.add(lemma)
+			allNames |= closure
+	names = sorted(allNames)
+	nameIds = {n:i for (i,n) in enumerate(names)}
+	offsets = dict()
+	ids = dict()
+	for pos in HypernymIndex.POS:
+		offsets[pos] = array('I', [0])
+		ids[pos] = array('I')
+		for n in names:
+			if n in closures[pos]:
+				ids[pos].extend(sorted(nameIds[c] for c in closures[pos][n]))
+			offsets[pos].append(len(ids[pos]))
+	namesBlob = '\n'.join(names).encode('utf-8')
+	tmp = path + '.tmp'
+	with open(tmp, 'wb') as F:
+		F.write(struct.pack(HypernymIndex.HEADER, HypernymIndex.MAGIC, len(names), len(namesBlob), len(ids['n']), len(ids['v'])))
+		F.write(namesBlob + b'\0'*(-len(namesBlob) % 4))
+		for pos in HypernymIndex.POS:
+			offsets[pos].tofile(F)
+		for pos in HypernymIndex.POS:
+			ids[pos].tofile(F)
+	os.replace(tmp, path)
+
+if __name__=="__main__":
+	if len(sys.argv)>1 and sys.argv[1]=='build':
+		path = sys.argv[2] if len(sys.argv)>2 else hypernymIndexLocation
+		print("Building hypernym index at", path, "...")
+		buildHypernymIndex(path)
+		print("Done.")
+
 # print(findHypernym('person', 'women'))
-# print(findHypernym('jog', 'running'))
\ No newline at end of file
+# print(findHypernym('jog', 'running'))